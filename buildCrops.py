@@ -0,0 +1,16 @@
+import sys
+import param
+import datageneration
+
+#Writes a crop cache for every video in a list (e.g. train_vids.txt): a tile
+#around the person in each frame, at the scale and with the margins the feed
+#needs for the current params. Passing <crop dir>/index.idx to createFeed in
+#place of the list then warps the tiles instead of decoding whole frames.
+
+if __name__ == "__main__":
+	if(len(sys.argv) != 3):
+		print "Need video list and crop directory as command line arguments."
+	else:
+		params = param.getGeneralParams()
+		n_frames = datageneration.buildCropCache(sys.argv[1],sys.argv[2],params)
+		print "Cropped " + str(n_frames) + " frames."
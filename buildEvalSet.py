@@ -0,0 +1,19 @@
+import sys
+import param
+import datageneration
+
+#Renders a fixed evaluation set from a video list (e.g. test_vids.txt) into a
+#directory of memory-mapped arrays, which datageneration.evalSetFeed replays.
+#Without a directory it is written to params['eval_dir'], where
+#createEvalFeed looks for it.
+
+if __name__ == "__main__":
+	if(len(sys.argv) < 2 or len(sys.argv) > 3):
+		print "Need video list and optionally eval directory as command line arguments."
+	else:
+		params = param.getGeneralParams()
+		eval_dir = params['eval_dir']
+		if(len(sys.argv) == 3):
+			eval_dir = sys.argv[2]
+		datageneration.writeEvalSet(params,sys.argv[1],eval_dir,params['eval_batches'])
+		print "Wrote " + str(params['eval_batches']*params['batch_size']) + " examples."
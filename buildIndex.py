@@ -0,0 +1,13 @@
+import sys
+import datareader
+
+#Packs the annotations of every video in a list (e.g. train_vids.txt) into one
+#index file that createFeed can open in place of the list. Rerunning it only
+#rereads the .mat files that changed since the index was written.
+
+if __name__ == "__main__":
+	if(len(sys.argv) != 3):
+		print "Need video list and index file as command line arguments."
+	else:
+		n_loaded = datareader.buildVidIndex(sys.argv[1],sys.argv[2])
+		print "Read " + str(n_loaded) + " annotation files."
@@ -0,0 +1,14 @@
+import sys
+import datareader
+
+#Packs the frames of every video in a list (e.g. train_vids.txt) into large
+#shard files in a directory, along with an annotation index, index.idx.
+#Passing that index to createFeed in place of the list reads the frames from
+#the shards.
+
+if __name__ == "__main__":
+	if(len(sys.argv) != 3):
+		print "Need video list and shard directory as command line arguments."
+	else:
+		n_shards = datareader.buildFrameShards(sys.argv[1],sys.argv[2])
+		print "Wrote " + str(n_shards) + " shards."
@@ -1,4 +1,8 @@
 import os
+import Queue
+import cPickle
+import threading
+import multiprocessing
 import numpy as np
 import json
 import cv2
@@ -6,6 +10,7 @@ import scipy.io as sio
 from scipy import interpolate
 import transformations
 import datareader
+from keras.utils import Sequence
 
 limbs = [[0,1],[2,3],[3,4],[5,6],[6,7],[8,9],[9,10],[11,12],[12,13],[2,5,8,11]]	
 
@@ -21,137 +26,825 @@ def getPersonScale(joints):
 	size = np.max([2.5 * torso_size,calf_size*5,peak_to_peak*1.1]) 
 	return (size/200.0)
 
-def getExampleInfo(vid_name,frame_num,box,X):
-	I_name_j = os.path.join(vid_name,str(frame_num+1)+'.jpg')
+def readExampleInfo(vid_info_list,example):
+	#example is a datareader.example_dtype record of vid_info_list.
+	I = datareader.readFrame(datareader.getExamplePath(vid_info_list,example))
+	joints,scale,pos = parseExampleInfo(example)
+	return (I,joints,scale,pos)
 
-	if(not os.path.isfile(I_name_j)):
-		I_name_j = os.path.join(vid_name,str(frame_num+1)+'.png')
+def parseExampleInfo(example):
+	return (example['joints'],example['scale'],example['pos'])
+
+def getDecodeReduction(scale,param):
+	#Largest of 1,2,4,8 (up to param['max_decode_reduction']) by which a frame
+	#can be shrunk when decoding and still only be downsampled by a warp to
+	#the given output scale, with augScale at its maximum.
+	r = 1
+	while(2*r <= param['max_decode_reduction'] and 2*r*scale*param['scale_max'] <= 1):
+		r *= 2
+	return r
+
+def getDecodeTransform(r):
+	#3x3 matrix taking frame coordinates to those of a 1/r decode, where
+	#pixel i covers frame pixels r*i to r*i+r-1.
+	offset = -(r-1)/(2.0*r)
+	return np.array([[1.0/r,0,offset],[0,1.0/r,offset],[0,0,1.0]])
+
+def readExampleImage(vid_info_list,example,pos,scale,param,decoded=None):
+	#Decodes the frame of example at the lowest resolution the warp of the
+	#output window at pos and scale allows, or reads its tile if its video is
+	#in a crop cache and the tile holds the window. Returns the image and the
+	#3x3 matrix taking frame coordinates to image coordinates. decoded is an
+	#optional datareader.FrameCache the frame is read through, shared with
+	#earlier calls.
+	path = datareader.getExamplePath(vid_info_list,example)
+	source = datareader.frame_sources.get(os.path.dirname(path))
+	if(isinstance(source,datareader.CropFrameSource)):
+		A = source.cropTransform(path)
+		#A tile is cut around its own frame's person, and the window of a
+		#pair follows the other frame when that one's person is larger.
+		if(cropHoldsWindow(source.shape,A,pos,scale,param)):
+			return source.readCrop(path),A
+
+	r = getDecodeReduction(scale,param)
+	if(decoded is None):
+		return datareader.readFrame(path,r),getDecodeTransform(r)
+	return decoded.get((path,r),lambda: datareader.readFrame(path,r)),getDecodeTransform(r)
+
+
+def sampleWarpExample(vid_info_list,param,rng=np.random,do_augment=True):
+	#Draws everything random about one training pair: the video, the two
+	#frames and the augmentation parameters. rng is any object with the
+	#np.random interface, so a seeded RandomState gives a reproducible sample.
+
+	#1. choose random video.
+	vid = rng.choice(len(vid_info_list),1)[0]
+	n_frames = vid_info_list[vid][2].shape[2]
+
+	#2. choose pair of frames
+	frames = sampleFramePair(n_frames,rng)
+
+	aug = None
+	if(do_augment):
+		aug = randAugmentations(param,rng)
+
+	return (vid,frames,aug)
+
+def sampleWarpExampleRecords(vid_info_list,param,n_examples,rng=np.random):
+	#n_examples pairs drawn as by sampleWarpExample, as an (n_examples,2)
+	#array of example records.
+	ex = np.zeros((n_examples,2),dtype=datareader.example_dtype)
+	for i in xrange(n_examples):
+		vid,frames,aug = sampleWarpExample(vid_info_list,param,rng,False)
+		ex[i] = datareader.makeExamples(vid_info_list,vid,frames)
+	return ex
+
+def isValidFramePair(frames,n_frames):
+	return abs(frames[0] - frames[1])/(n_frames*1.0) > 0.02
+
+def sampleFramePair(n_frames,rng=np.random):
+	#Uniform over the ordered pairs of frames more than 2% of the video apart.
+	frames = rng.choice(n_frames,2,replace=False)
+	while(not isValidFramePair(frames,n_frames)):
+		frames = rng.choice(n_frames,2,replace=False)
+	return frames
+
+def sampleLocalWarpExamples(vid_info_list,param,batch_size,rng=np.random,do_augment=True):
+	#Samples for a group of G*F*(F-1)/2 batches, F = param['locality_frames']
+	#and G = param['locality_groups'], that decode only F frames of each of
+	#their G*batch_size videos. Each video draws F frames independently and
+	#uniformly and gives the F*(F-1)/2 pairs among them, a pair that is too
+	#close being replaced by a sampleFramePair draw. Every sample is then
+	#distributed exactly as in sampleWarpExample. The videos come in G
+	#blocks of batch_size, and batch j*G+g gets one pair of every video of
+	#block g: consecutive batches have different videos, and the batches
+	#sharing a block's videos are G apart.
+
+	n_drawn = param['locality_frames']
+	n_groups = param['locality_groups']
+	n_pairs = n_drawn*(n_drawn-1)/2
+	batches = [[] for j in xrange(n_pairs*n_groups)]
+
+	for i in xrange(n_groups*batch_size):
+		g = i//batch_size
+		vid = rng.choice(len(vid_info_list),1)[0]
+		n_frames = vid_info_list[vid][2].shape[2]
+		drawn = rng.choice(n_frames,n_drawn)
+
+		pairs = []
+		for a in xrange(n_drawn):
+			for b in xrange(a+1,n_drawn):
+				frames = np.array([drawn[a],drawn[b]])
+				if(not isValidFramePair(frames,n_frames)):
+					frames = sampleFramePair(n_frames,rng)
+				pairs.append(frames)
+
+		order = rng.permutation(n_pairs)
+		for j in xrange(n_pairs):
+			aug = None
+			if(do_augment):
+				aug = randAugmentations(param,rng)
+			batches[j*n_groups + g].append((vid,pairs[order[j]],aug))
 
-	joints = X[:,:,frame_num]-1.0
-	box_j = box[frame_num,:]
-	scale = getPersonScale(joints)
-	pos = [(box_j[0] + box_j[2]/2.0), (box_j[1] + box_j[3]/2.0)] 
-	lj = [I_name_j] + np.ndarray.tolist(joints.flatten()) + pos + [scale]
-	return lj
+	for samples in batches:
+		rng.shuffle(samples)
 
-def readExampleInfo(example):
-	I = cv2.imread(example[0])
-	joints = np.reshape(np.array(example[1:29]), (14,2))
-	scale = example[31]
-	pos = np.array(example[29:31])
-	return (I,joints,scale,pos)
+	return batches
 
 
-def warpExampleGenerator(vid_info_list,param,do_augment=True,return_pose_vectors=False,return_class=False):
-    
+def allocWarpBatch(param,batch_size,pad=None):
+	#Output arrays for one batch, in the order makeWarpBatch fills them. 
+	#Images are uint8 in [0,255] if param['feed_uint8_images'] is set and
+	#are then normalized by the consumer with normalizeBatch. With
+	#param['render_in_graph'] the maps, priors and transforms are not made
+	#and their arrays are None. If pad=(x,y) is given, images are tiles of
+	#the output window padded by pad, and X_aug holds the augmentations the
+	#graph applies to them (param['augment_in_graph']). With
+	#param['sparse_heatmaps'] the pose maps are (B,n_joints,3) records from
+	#makeJointRecords. X_class holds the class id of each example's video.
+
 	img_width = param['IMG_WIDTH']
 	img_height = param['IMG_HEIGHT']
 	pose_dn = param['posemap_downsample']
-	sigma_joint = param['sigma_joint']
 	n_joints = param['n_joints']
-	scale_factor = param['obj_scale_factor']	
-	batch_size = param['batch_size']
 
-	while True:
+	img_type = np.float32
+	if(param['feed_uint8_images']):
+		img_type = np.uint8
+
+	tile_width = img_width
+	tile_height = img_height
+	X_aug = None
+	if(pad is not None):
+		tile_width += 2*pad[0]
+		tile_height += 2*pad[1]
+		X_aug = np.zeros((batch_size,6),dtype=np.float32)
+
+	X_src = np.zeros((batch_size,tile_height,tile_width,3),dtype=img_type)
+	X_pose_src = X_pose_tgt = X_mask_src = X_trans = None
+	if(not param['render_in_graph']):
+		pose_shape = (batch_size,img_height/pose_dn,img_width/pose_dn,n_joints)
+		if(param['sparse_heatmaps']):
+			pose_shape = (batch_size,n_joints,3)
+		X_pose_src = np.zeros(pose_shape,dtype=np.float32)
+		X_pose_tgt = np.zeros(pose_shape,dtype=np.float32)
+		mask_dn = param['mask_downsample']
+		X_mask_src = np.zeros((batch_size,img_height/mask_dn,img_width/mask_dn,len(limbs)+1),dtype=np.float32)
+		X_trans = np.zeros((batch_size,2,3,len(limbs)+1),dtype=np.float32)
+	X_posevec_src = np.zeros((batch_size,n_joints*2),dtype=np.float32)
+	X_posevec_tgt = np.zeros((batch_size,n_joints*2),dtype=np.float32)
+	X_class = np.zeros((batch_size,1),dtype=np.float32)
+	Y = np.zeros((batch_size,tile_height,tile_width,3),dtype=img_type)
+
+	return [X_src,X_pose_src,X_pose_tgt,X_mask_src,X_trans,X_posevec_src,X_posevec_tgt,X_class,X_aug,Y]
+
+
+def readWarpPair(vid_info_list,param,vid,frames,decoded=None):
+	#Reads the two frames of a sample. Returns (I0,A0,joints0,I1,A1,joints1,pos,scale):
+	#the images with the matrices taking frame coordinates to their image
+	#coordinates (see readExampleImage), the joints in frame coordinates, and
+	#the center and scale of the sample's output window.
 
-		X_src = np.zeros((batch_size,img_height,img_width,3))
-		X_mask_src = np.zeros((batch_size,img_height,img_width,len(limbs)+1))
-		X_pose_src = np.zeros((batch_size,img_height/pose_dn,img_width/pose_dn,14))
-		X_pose_tgt = np.zeros((batch_size,img_height/pose_dn,img_width/pose_dn,14))
-		X_trans = np.zeros((batch_size,2,3,11))
-		X_posevec_src = np.zeros((batch_size,n_joints*2))
-		X_posevec_tgt = np.zeros((batch_size,n_joints*2))
-		#X_class = np.zeros((batch_size,1))
-		Y = np.zeros((batch_size,img_height,img_width,3))
+	scale_factor = param['obj_scale_factor']	
+
+	example0,example1 = datareader.makeExamples(vid_info_list,vid,frames)
 	
-		for i in xrange(batch_size):
-				
-			#1. choose random video.
-			vid = np.random.choice(len(vid_info_list),1)[0]		
-			vid_info = vid_info_list[vid][0]
-			vid_bbox = vid_info_list[vid][1]
-			vid_X = vid_info_list[vid][2]
-			vid_path = vid_info_list[vid][3]	
-			#vid_class = vid_info_list[vid][4]			
-
-			#2. choose pair of frames
-			n_frames = vid_X.shape[2]	
-			frames = np.random.choice(n_frames,2,replace=False)
-			while(abs(frames[0] - frames[1])/(n_frames*1.0) <= 0.02):
-				frames = np.random.choice(n_frames,2,replace=False)
-
-			example0 = getExampleInfo(vid_path,frames[0],vid_bbox,vid_X)
-			example1 = getExampleInfo(vid_path,frames[1],vid_bbox,vid_X)
-			
-			I0,joints0,scale0,pos0 = readExampleInfo(example0)
-			I1,joints1,scale1,pos1 = readExampleInfo(example1)
-			#X_class[i,0] = vid_class
-
-			#pos = pos0		
-			#scale=scale_factor/scale0
-			if(scale0 > scale1):
-				pos = pos0
-				scale = scale_factor/scale0
-			else:
-				pos = pos1
-				scale = scale_factor/scale1	
+	joints0,scale0,pos0 = parseExampleInfo(example0)
+	joints1,scale1,pos1 = parseExampleInfo(example1)
 
-			I0,joints0 = centerAndScaleImage(I0,img_width,img_height,pos,scale,joints0)
-			I1,joints1 = centerAndScaleImage(I1,img_width,img_height,pos,scale,joints1)
+	#pos = pos0		
+	#scale=scale_factor/scale0
+	if(scale0 > scale1):
+		pos = pos0
+		scale = scale_factor/scale0
+	else:
+		pos = pos1
+		scale = scale_factor/scale1	
 
-			I0 = (I0/255.0 - 0.5)*2.0
-			I1 = (I1/255.0 - 0.5)*2.0
+	I0,A0 = readExampleImage(vid_info_list,example0,pos,scale,param,decoded)
+	I1,A1 = readExampleImage(vid_info_list,example1,pos,scale,param,decoded)
 
-			if(do_augment):
-				rflip,rscale,rshift,rdegree,rsat = randAugmentations(param)				
-				#rshift2 = randShift(param)
-				#rshift0 = (rshift[0] + rshift2[0], rshift[1]+rshift2[1])
-				I0,joints0 = augment(I0,joints0,rflip,rscale,rshift,rdegree,rsat,img_height,img_width)	
-				I1,joints1 = augment(I1,joints1,rflip,rscale,rshift,rdegree,rsat,img_height,img_width)	
+	return (I0,A0,joints0,I1,A1,joints1,pos,scale)
 
-			posemap0 = makeJointHeatmaps(img_height,img_width,joints0,sigma_joint,pose_dn)
-			posemap1 = makeJointHeatmaps(img_height,img_width,joints1,sigma_joint,pose_dn)
 
-			src_limb_masks = makeLimbMasks(joints0,img_width,img_height)	
-			src_bg_mask = np.expand_dims(1.0 - np.amax(src_limb_masks,axis=2),2)
-			src_masks = np.log(np.concatenate((src_bg_mask,src_limb_masks),axis=2)+1e-10)
+def makeWarpBatch(vid_info_list,param,samples,return_pose_vectors=False,return_class=False,buffers=None,decoded=None):
+	#Builds one batch from a list of (vid,frames,aug) tuples made by sampleWarpExample.
+	#The batch is written into buffers (from allocWarpBatch) if given. Frames
+	#are shared with other batches through decoded (see readExampleImage).
+	pairs = (readWarpPair(vid_info_list,param,vid,frames,decoded) for vid,frames,aug in samples)
+	classes = [vid_info_list[vid][7] for vid,frames,aug in samples]
+	return renderWarpBatch(param,pairs,[aug for vid,frames,aug in samples],
+						   return_pose_vectors,return_class,buffers,classes)
 
-			X_src[i,:,:,:] = I0
-			X_pose_src[i,:,:,:] = posemap0
-			X_pose_tgt[i,:,:,:] = posemap1
-			X_mask_src[i,:,:,:] = src_masks
-			X_trans[i,:,:,0] = np.array([[1.0,0.0,0.0],[0.0,1.0,0.0]])
-			X_trans[i,:,:,1:] = getLimbTransforms(joints0,joints1)
 
-			X_posevec_src[i,:] = joints0.flatten()
-			X_posevec_tgt[i,:] = joints1.flatten()
+def renderWarpBatch(param,pairs,augs,return_pose_vectors=False,return_class=False,buffers=None,classes=None):
+	#Builds a batch from pairs made by readWarpPair (any iterable, read as it
+	#is rendered) and their augmentations. classes are the class ids of the
+	#pairs' videos, which return_class appends to the inputs. With param['render_in_graph'] the
+	#inputs are just [X_src,X_posevec_src,X_posevec_tgt]. With
+	#param['augment_in_graph'] the augmentations are left to the graph
+	#(networks.augmentBatch): the images are padded tiles of the unaugmented
+	#output window and the inputs are [X_src,X_posevec_src,X_posevec_tgt,X_aug].
 
-			Y[i,:,:,:] = I1
-		
-		out = [X_src,X_pose_src,X_pose_tgt,X_mask_src,X_trans]
-		
-		if(return_pose_vectors):
-			out.append(X_posevec_src)
-			out.append(X_posevec_tgt)		
+	img_width = param['IMG_WIDTH']
+	img_height = param['IMG_HEIGHT']
+	pose_dn = param['posemap_downsample']
+	sigma_joint = param['sigma_joint']
+	n_joints = param['n_joints']
+	limb_cutoff = param['limb_mask_cutoff']
+	mask_dn = param['mask_downsample']
+	render_in_graph = param['render_in_graph']
+	batch_size = len(augs)
+
+	pad = None
+	in_graph_aug = param['augment_in_graph'] and any(aug is not None for aug in augs)
+	if(in_graph_aug):
+		pad = getCropPadding(param)
+		render_in_graph = True
+
+	if(buffers is None):
+		buffers = allocWarpBatch(param,batch_size,pad)
+	X_src,X_pose_src,X_pose_tgt,X_mask_src,X_trans,X_posevec_src,X_posevec_tgt,X_class,X_aug,Y = buffers
+	tile_width = X_src.shape[2]
+	tile_height = X_src.shape[1]
+	if(return_class):
+		X_class[:,0] = classes
+
+	joints_src = np.zeros((batch_size,n_joints,2))
+	joints_tgt = np.zeros((batch_size,n_joints,2))
+
+	for i,pair in enumerate(pairs):
+		I0,A0,joints0,I1,A1,joints1,pos,scale = pair
+		aug = augs[i]
+		if(in_graph_aug):
+			rflip,rscale,rshift,rdegree,rsat = aug
+			X_aug[i] = [rflip,rscale,rshift[0],rshift[1],rdegree,rsat]
+			aug = None
+
+		#Centering and the geometric augmentations are a single warp from the
+		#decoded frame straight to the output window.
+		M = getWarpTransform(img_width,img_height,pos,scale,aug)
+		if(pad is not None):
+			M[0:2,2] += pad
+		flip = (aug is not None and aug[0] >= 0.5)
+		I0,joints_src[i] = warpExample(I0,joints0,M,tile_width,tile_height,flip,A0)
+		I1,joints_tgt[i] = warpExample(I1,joints1,M,tile_width,tile_height,flip,A1)
+
+		rsat = None
+		if(aug is not None):
+			rsat = aug[4]
+
+		writeImage(I0,X_src[i],rsat)
+		writeImage(I1,Y[i],rsat)
+		if(not render_in_graph):
+			makeLimbMaskPriors(joints_src[i],img_width,img_height,limb_cutoff,X_mask_src[i],mask_dn)
+
+	if(pad is not None):
+		joints_src -= pad
+		joints_tgt -= pad
+
+	X_posevec_src[:] = np.reshape(joints_src,(batch_size,-1))
+	X_posevec_tgt[:] = np.reshape(joints_tgt,(batch_size,-1))
+
+	if(render_in_graph):
+		out = [X_src,X_posevec_src,X_posevec_tgt]
+		if(in_graph_aug):
+			out.append(X_aug)
 		if(return_class):
 			out.append(X_class)
+		return (out,Y)
+
+	if(param['sparse_heatmaps']):
+		makeJointRecords(img_height,img_width,joints_src,pose_dn,X_pose_src)
+		makeJointRecords(img_height,img_width,joints_tgt,pose_dn,X_pose_tgt)
+	else:
+		makeJointHeatmapsBatch(img_height,img_width,joints_src,sigma_joint,pose_dn,X_pose_src)
+		makeJointHeatmapsBatch(img_height,img_width,joints_tgt,sigma_joint,pose_dn,X_pose_tgt)
+
+	X_trans[:,:,:,0] = np.array([[1.0,0.0,0.0],[0.0,1.0,0.0]])
+	X_trans[:,:,:,1:] = getLimbTransformsBatch(joints_src,joints_tgt)
+	
+	out = [X_src,X_pose_src,X_pose_tgt,X_mask_src,X_trans]
+	
+	if(return_pose_vectors):
+		out.append(X_posevec_src)
+		out.append(X_posevec_tgt)		
+	if(return_class):
+		out.append(X_class)
+
+	return (out,Y)
+
+
+def writeImage(I,out,rsat=None):
+	#Writes a warped uint8 image into a batch slot. Float slots get the
+	#[-1,1] normalization and saturation augmentation of the old
+	#augSaturation. uint8 slots get the same saturation change in pixel units,
+	#rounded and clipped to [0,255].
+
+	if(out.dtype == np.uint8):
+		if(rsat is None):
+			out[...] = I
+		else:
+			out[...] = np.clip(np.rint((I - np.float32(127.5))*np.float32(rsat) + np.float32(127.5)),0,255)
+		return
+
+	np.multiply(I,np.float32(2/255.0),out=out)
+	out -= 1
+	if(rsat is not None):
+		out *= rsat
+		np.minimum(out,1,out=out)
+
+
+def normalizeImages(I):
+	return I*np.float32(2/255.0) - 1
+
+def densifyBatch(X,param):
+	#Consumer side of param['sparse_heatmaps']: renders the joint records of
+	#a batch into the pose maps the networks take. Other batches are
+	#returned as they are.
+	if(X[1].ndim != 3):
+		return X
+	pose_dn = param['posemap_downsample']
+	height = param['IMG_HEIGHT']/pose_dn
+	width = param['IMG_WIDTH']/pose_dn
+	maps = [densifyJointRecords(r,height,width,param['sigma_joint']) for r in X[1:3]]
+	return [X[0]] + maps + X[3:]
+
+def normalizeBatch(X,Y):
+	#Consumer side of param['feed_uint8_images']: turns uint8 source and
+	#target images into the [-1,1] float32 images the networks expect.
+	if(X[0].dtype == np.uint8):
+		X = [normalizeImages(X[0])] + X[1:]
+		Y = normalizeImages(Y)
+	return X,Y
 
-		yield (out,Y)
 
+def warpExampleGenerator(vid_info_list,param,do_augment=True,return_pose_vectors=False,return_class=False):
+    
+	batch_size = param['batch_size']
+
+	#Batches are written into a ring of preallocated buffers. A yielded
+	#batch stays valid until feed_n_buffers-1 more batches have been drawn.
+	n_buffers = param['feed_n_buffers']
+	pad = None
+	if(param['augment_in_graph'] and do_augment):
+		pad = getCropPadding(param)
+	buffers = [allocWarpBatch(param,batch_size,pad) for i in xrange(n_buffers)]
+	step = 0
+
+	reservoir = None
+	if(param['sample_reuse'] > 1):
+		reservoir = SampleReservoir(vid_info_list,param,param['reuse_reservoir_size'],
+									param['sample_reuse'],reuse_stats)
+
+	#The frames a locality group decodes are shared by all its batches.
+	decoded = None
+	if(param['locality_frames'] > 1):
+		decoded = datareader.FrameCache(param['locality_cache_bytes'])
+
+	while True:
+		if(reservoir is not None):
+			vids,pairs = zip(*[reservoir.take() for i in xrange(batch_size)])
+			augs = [None]*batch_size
+			if(do_augment):
+				augs = [randAugmentations(param) for i in xrange(batch_size)]
+			yield renderWarpBatch(param,pairs,augs,return_pose_vectors,return_class,
+								  buffers[step % n_buffers],[vid_info_list[vid][7] for vid in vids])
+			step += 1
+		elif(param['locality_frames'] > 1):
+			for samples in sampleLocalWarpExamples(vid_info_list,param,batch_size,np.random,do_augment):
+				yield makeWarpBatch(vid_info_list,param,samples,return_pose_vectors,return_class,
+									buffers[step % n_buffers],decoded)
+				step += 1
+		else:
+			samples = [sampleWarpExample(vid_info_list,param,np.random,do_augment) for i in xrange(batch_size)]
+			yield makeWarpBatch(vid_info_list,param,samples,return_pose_vectors,return_class,
+								buffers[step % n_buffers])
+			step += 1
+
+
+class WarpSequence(Sequence):
+	#Index-addressable version of warpExampleGenerator. Batch idx of a given
+	#epoch is always drawn from its own RandomState seeded with
+	#(seed,epoch,idx), so batches can be built in any order, by any number
+	#of workers, and rebuilt identically on retry.
+
+	def __init__(self,vid_info_list,param,n_batches,seed=0,do_augment=True,
+				 return_pose_vectors=False,return_class=False):
+		self.vid_info_list = vid_info_list
+		self.param = param
+		self.n_batches = n_batches
+		self.seed = seed
+		self.do_augment = do_augment
+		self.return_pose_vectors = return_pose_vectors
+		self.return_class = return_class
+		self.epoch = 0
+
+	def __len__(self):
+		return self.n_batches
+
+	def getSamples(self,idx):
+		#With param['locality_frames'] > 1, batch idx is one of the batches of
+		#a group drawn by sampleLocalWarpExamples; decodes are then only
+		#shared through the frame cache.
+		n_drawn = self.param['locality_frames']
+		if(n_drawn > 1):
+			n_group = self.param['locality_groups']*n_drawn*(n_drawn-1)/2
+			rng = np.random.RandomState([self.seed,self.epoch,idx//n_group])
+			return sampleLocalWarpExamples(self.vid_info_list,self.param,self.param['batch_size'],
+										   rng,self.do_augment)[idx % n_group]
+
+		rng = np.random.RandomState([self.seed,self.epoch,idx])
+		return [sampleWarpExample(self.vid_info_list,self.param,rng,self.do_augment) 
+				for i in xrange(self.param['batch_size'])]
+
+	def __getitem__(self,idx):
+		return makeWarpBatch(self.vid_info_list,self.param,self.getSamples(idx),
+							 self.return_pose_vectors,self.return_class)
+
+	def on_epoch_end(self):
+		self.epoch += 1
+
+
+def centerWarpPair(param,pair):
+	#Warps both images of a pair from readWarpPair to tiles of its output
+	#window before augmentation, padded by getCropPadding so that they hold
+	#all that any augmented warp can see. Returns the pair with the tiles
+	#and their matrices in place of the images.
+	I0,A0,joints0,I1,A1,joints1,pos,scale = pair
 
-def createFeed(params,vid_file,do_augment=True,return_pose_vectors=False,return_class=False,transfer=False):
-	#ex_list = datareader.makeWarpExampleList(ex_file,n_examples)
-	vid_info_list = datareader.makeVidInfoList(vid_file)
+	img_width = param['IMG_WIDTH']
+	img_height = param['IMG_HEIGHT']
+	pad = getCropPadding(param)
+	size = (img_width + 2*pad[0],img_height + 2*pad[1])
+
+	T = getWarpTransform(img_width,img_height,pos,scale)
+	T[0:2,2] += pad
+	tile0 = cv2.warpAffine(I0,np.dot(T,np.linalg.inv(A0))[0:2,:],size)
+	tile1 = cv2.warpAffine(I1,np.dot(T,np.linalg.inv(A1))[0:2,:],size)
+
+	return (tile0,T,joints0,tile1,T,joints1,pos,scale)
+
+
+class ReuseStats(object):
+	#Pairs decoded and samples served by the SampleReservoirs of all feed
+	#processes. Create it before the feed workers are started.
+
+	def __init__(self):
+		self.decoded = multiprocessing.Value('l',0)
+		self.served = multiprocessing.Value('l',0)
+
+	def add(self,n_decoded,n_served):
+		with self.decoded.get_lock():
+			self.decoded.value += n_decoded
+		with self.served.get_lock():
+			self.served.value += n_served
+
+	def stats(self):
+		n_decoded = self.decoded.value
+		n_served = self.served.value
+		return {'decoded': n_decoded, 'served': n_served,
+				'samples_per_decode': n_served/float(max(n_decoded,1))}
+
+reuse_stats = None
+
+
+class SampleReservoir(object):
+	#Holds up to size decoded pairs, centered once by centerWarpPair. take()
+	#serves a random one with the index of its video, which its caller renders with freshly drawn
+	#augmentations, and drops it after it has been served reuse times. A
+	#background thread decodes new pairs to replace the dropped ones.
+
+	def __init__(self,vid_info_list,param,size,reuse,stats=None):
+		self.vid_info_list = vid_info_list
+		self.param = param
+		self.size = size
+		self.reuse = reuse
+		self.stats = stats
+		self.entries = []
+		self.cond = threading.Condition()
+
+		self.thread = threading.Thread(target=self.fill)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def fill(self):
+		while True:
+			with self.cond:
+				while(len(self.entries) >= self.size):
+					self.cond.wait()
+
+			vid,frames,aug = sampleWarpExample(self.vid_info_list,self.param,np.random,False)
+			pair = centerWarpPair(self.param,readWarpPair(self.vid_info_list,self.param,vid,frames))
+			if(self.stats is not None):
+				self.stats.add(1,0)
+
+			with self.cond:
+				self.entries.append([pair,0,vid])
+				self.cond.notify_all()
+
+	def take(self,rng=np.random):
+		with self.cond:
+			while(len(self.entries) == 0):
+				if(not self.thread.is_alive()):
+					raise RuntimeError('Sample reservoir fill thread exited')
+				self.cond.wait(1.0)
+
+			k = rng.randint(len(self.entries))
+			entry = self.entries[k]
+			entry[1] += 1
+			if(entry[1] >= self.reuse):
+				self.entries[k] = self.entries[-1]
+				self.entries.pop()
+				self.cond.notify_all()
+
+		if(self.stats is not None):
+			self.stats.add(0,1)
+		return (entry[2],entry[0])
+
+
+def setupFrameReading(params,vid_file,frame_source=None):
+	#The frame source for vid_file and the frame cache are module state of
+	#datareader, so that feed workers inherit them. frame_source is one of
+	#datareader.frame_source_kinds, see datareader.openFrameSource.
+	source = datareader.openFrameSource(vid_file,frame_source,params['video_seek_frames'],
+										params['video_run_frames'])
+	if(source is not None):
+		datareader.addFrameSource(source)
+
+	if(params['frame_cache_bytes'] > 0 and datareader.frame_cache is None):
+		datareader.setFrameCache(params['frame_cache_bytes'])
+
+
+def createSequence(params,vid_file,n_batches,seed=0,do_augment=True,return_pose_vectors=False,return_class=False,frame_source=None):
+	vid_info_list = datareader.loadVidInfo(vid_file,params['vid_cache_size'])
+	setupFrameReading(params,vid_file,frame_source)
+
+	return WarpSequence(vid_info_list,params,n_batches,seed,do_augment,return_pose_vectors,return_class)
+
+
+def createFeed(params,vid_file,do_augment=True,return_pose_vectors=False,return_class=False,transfer=False,frame_source=None):
+	#With transfer, the feed is transferExampleGenerator over 5000 pairs of
+	#vid_file, as many as the old example lists held.
+	vid_info_list = datareader.loadVidInfo(vid_file,params['vid_cache_size'])
+	setupFrameReading(params,vid_file,frame_source)
+
+	#Shared by the feed processes, like the frame cache.
+	global reuse_stats
+	if(params['sample_reuse'] > 1 and reuse_stats is None):
+		reuse_stats = ReuseStats()
 	
 	if(transfer):
-		feed = transferExampleGenerator(ex_list,ex_list,params)
+		ex_list = sampleWarpExampleRecords(vid_info_list,params,5000)
+		feed = transferExampleGenerator(vid_info_list,ex_list,ex_list,params)
+	elif(params['feed_workers'] > 0):
+		feed = prefetchFeed(vid_info_list,params,do_augment,return_pose_vectors,return_class)
 	else:
 		feed = warpExampleGenerator(vid_info_list,params,do_augment,return_pose_vectors,return_class)
 
 	return feed
 
 
-def transferExampleGenerator(examples0,examples1,param):
+#Params that decide which examples an eval set holds and the shapes and
+#dtypes of its arrays. eval.json records them, and a set written with other
+#values is rebuilt.
+eval_set_params = ['IMG_HEIGHT','IMG_WIDTH','obj_scale_factor','posemap_downsample','sigma_joint',
+				   'n_joints','limb_mask_cutoff','mask_downsample','render_in_graph','sparse_heatmaps',
+				   'feed_uint8_images','batch_size','seq_len','locality_frames','locality_groups']
+
+def evalSetHeader(params,vid_file,n_batches,seed,n_inputs=None):
+	header = {'vid_file': vid_file,'seed': seed,'n_examples': n_batches*params['batch_size'],
+			  'batch_size': params['batch_size'],'class_file': 'class.npy',
+			  'params': dict((k,params[k]) for k in eval_set_params)}
+	if(n_inputs is not None):
+		header['n_inputs'] = n_inputs
+
+	#As it reads back from eval.json.
+	return json.loads(json.dumps(header))
+
+def writeEvalSet(params,vid_file,eval_dir,n_batches,seed=0,return_pose_vectors=True,frame_source=None):
+	#Renders n_batches unaugmented batches of vid_file, drawn as by
+	#createSequence with seed, into eval_dir: each input as X<k>.npy, the
+	#class ids as class.npy and the target as Y.npy, with all batches
+	#stacked, and eval.json, which is written last and marks the set complete.
+
+	header_file = os.path.join(eval_dir,'eval.json')
+	if(os.path.isfile(header_file)):
+		os.remove(header_file)
+
+	seq = createSequence(params,vid_file,n_batches,seed,False,return_pose_vectors,True,frame_source)
+	batch_size = params['batch_size']
+	n_examples = n_batches*batch_size
+
+	if(not os.path.isdir(eval_dir)):
+		os.makedirs(eval_dir)
+
+	arrays = None
+	for i in xrange(n_batches):
+		X,Y = seq[i]
+		batch = X + [Y]
+		if(arrays is None):
+			names = ['X' + str(k) + '.npy' for k in xrange(len(X)-1)] + ['class.npy','Y.npy']
+			arrays = [np.lib.format.open_memmap(os.path.join(eval_dir,name),mode='w+',dtype=a.dtype,
+												shape=(n_examples,) + a.shape[1:]) for name,a in zip(names,batch)]
+		for a,b in zip(arrays,batch):
+			a[i*batch_size:(i+1)*batch_size] = b
+
+	for a in arrays:
+		a.flush()
+	del arrays
+
+	f = open(header_file,'w')
+	json.dump(evalSetHeader(params,vid_file,n_batches,seed,len(X)-1),f)
+	f.close()
+
+def loadEvalSet(eval_dir,return_class=False):
+	#The inputs and target of an eval set from writeEvalSet, memory-mapped.
+	#With return_class the class ids are appended to the inputs.
+	f = open(os.path.join(eval_dir,'eval.json'))
+	header = json.load(f)
+	f.close()
+
+	X = [np.load(os.path.join(eval_dir,'X' + str(k) + '.npy'),mmap_mode='r') for k in xrange(header['n_inputs'])]
+	if(return_class):
+		X.append(np.load(os.path.join(eval_dir,header['class_file']),mmap_mode='r'))
+	Y = np.load(os.path.join(eval_dir,'Y.npy'),mmap_mode='r')
+	return (X,Y,header)
+
+def evalSetFeed(eval_dir,batch_size=None,repeat=True,return_class=False):
+	#Replays an eval set in order, as slices of its memory maps; nothing is
+	#computed. With repeat=False the set is replayed once.
+	X,Y,header = loadEvalSet(eval_dir,return_class)
+	if(batch_size is None):
+		batch_size = header['batch_size']
+
+	while True:
+		for a in xrange(0,header['n_examples'],batch_size):
+			yield ([x[a:a+batch_size] for x in X],Y[a:a+batch_size])
+		if(not repeat):
+			return
+
+def createEvalFeed(params,vid_file,batch_size=None,repeat=False,frame_source=None,return_class=False):
+	#Feed over the eval set in params['eval_dir'], which is written from
+	#vid_file with params['eval_batches'] batches (with pose vectors, and
+	#class ids with return_class) the first time. Every script reading the same eval_dir sees the same examples.
+	#A set written from another vid_file, size or eval_set_params is rebuilt.
+	eval_dir = params['eval_dir']
+	header_file = os.path.join(eval_dir,'eval.json')
+	header = None
+	if(os.path.isfile(header_file)):
+		f = open(header_file)
+		header = json.load(f)
+		f.close()
+		header.pop('n_inputs',None)
+
+	if(header != evalSetHeader(params,vid_file,params['eval_batches'],0)):
+		if(header is not None):
+			print 'Eval set in ' + eval_dir + ' does not match params, rebuilding'
+		writeEvalSet(params,vid_file,eval_dir,params['eval_batches'],frame_source=frame_source)
+	return evalSetFeed(eval_dir,batch_size,repeat,return_class)
+
+
+class SlabRing(object):
+	#Fixed-size slots of one shared memory slab, handed between processes
+	#through a queue of free slot numbers and a queue of filled ones with the
+	#layout of their arrays. Create it before the workers are started.
+
+	align = 64
+
+	def __init__(self,n_slots,slot_bytes):
+		self.slot_bytes = slot_bytes
+		self.slab = multiprocessing.RawArray('B',n_slots*slot_bytes)
+		self.free = multiprocessing.Queue()
+		self.ready = multiprocessing.Queue()
+		for i in xrange(n_slots):
+			self.free.put(i)
+
+	@classmethod
+	def alignedBytes(cls,n_bytes):
+		return -(-n_bytes//cls.align)*cls.align
+
+	def view(self,slot,offset,dtype,shape):
+		count = int(np.prod(shape))
+		a = np.frombuffer(self.slab,dtype=dtype,count=count,offset=slot*self.slot_bytes + offset)
+		return a.reshape(shape)
+
+	def put(self,arrays):
+		#Copies arrays into the next free slot, waiting for one, and queues it.
+		layout = []
+		offset = 0
+		for a in arrays:
+			layout.append((a.dtype.str,a.shape,offset))
+			offset += self.alignedBytes(a.nbytes)
+		if(offset > self.slot_bytes):
+			raise ValueError('Batch of ' + str(offset) + ' bytes does not fit a slot of ' + str(self.slot_bytes))
+
+		slot = self.free.get()
+		for a,(dtype,shape,offset) in zip(arrays,layout):
+			self.view(slot,offset,dtype,shape)[...] = a
+		self.ready.put((slot,layout))
+
+	def get(self,timeout=None):
+		#The next filled slot and views of its arrays. Raises Queue.Empty
+		#after timeout seconds. The slot is the caller's until release.
+		slot,layout = self.ready.get(timeout=timeout)
+		return slot,[self.view(slot,offset,dtype,shape) for dtype,shape,offset in layout]
+
+	def release(self,slot):
+		self.free.put(slot)
+
+
+def _slabWorker(ring,seed,vid_info_list,param,do_augment,return_pose_vectors,return_class):
+	np.random.seed(seed)
+	feed = warpExampleGenerator(vid_info_list,param,do_augment,return_pose_vectors,return_class)
+	while True:
+		X,Y = next(feed)
+		ring.put(X + [Y])
+
+
+def _drainSlabRing(ring,workers):
+	#Yields views of the slots filled by the workers, without copying. The
+	#slot of a batch goes back to the workers on the next call, so a batch
+	#stays valid until the next one is drawn.
+	slot = None
+	while True:
+		if(slot is not None):
+			ring.release(slot)
+			slot = None
+		try:
+			slot,arrays = ring.get(timeout=1.0)
+		except Queue.Empty:
+			for w in workers:
+				if(not w.is_alive()):
+					raise RuntimeError('Feed worker ' + w.name + ' exited with code ' + str(w.exitcode))
+			continue
+		yield (arrays[:-1],arrays[-1])
+
+
+def _prefetchWorker(queue,seed,vid_info_list,param,do_augment,return_pose_vectors,return_class):
+	#Forked workers inherit the parent's random state, so reseed each one
+	#or they would all produce the same batches.
+	np.random.seed(seed)
+	feed = warpExampleGenerator(vid_info_list,param,do_augment,return_pose_vectors,return_class)
+	while True:
+		#Pickle before queueing: the queue's feeder thread would otherwise
+		#serialize the batch later, after the generator reused its buffers.
+		queue.put(cPickle.dumps(next(feed),cPickle.HIGHEST_PROTOCOL))
+
+
+def _drainPrefetchQueue(queue,workers):
+	while True:
+		try:
+			yield cPickle.loads(queue.get(timeout=1.0))
+		except Queue.Empty:
+			for w in workers:
+				if(not w.is_alive()):
+					raise RuntimeError('Feed worker ' + w.name + ' exited with code ' + str(w.exitcode))
+
+
+def prefetchFeed(vid_info_list,param,do_augment=True,return_pose_vectors=False,return_class=False):
+	#Runs param['feed_workers'] processes that each build whole batches with
+	#warpExampleGenerator and push them into a queue holding at most
+	#param['feed_queue_size'] ready batches. The workers start right away so
+	#the queue fills while the model is being built. With
+	#param['feed_shared_memory'] the batches are passed in the slots of a
+	#SlabRing rather than pickled, and stay valid until the next batch is
+	#drawn, as those of warpExampleGenerator.
+	n_workers = param['feed_workers']
+	seeds = np.random.randint(0,2**31-1,n_workers)
+
+	if(param['feed_shared_memory']):
+		#A slot for every ready batch and the trainer's batch; the workers
+		#build theirs in their own buffers and only take a slot to copy a
+		#finished one in. Batches are made of allocWarpBatch buffers.
+		pad = None
+		if(param['augment_in_graph'] and do_augment):
+			pad = getCropPadding(param)
+		buffers = allocWarpBatch(param,param['batch_size'],pad)
+		slot_bytes = sum([SlabRing.alignedBytes(b.nbytes) for b in buffers if b is not None])
+		out = SlabRing(param['feed_queue_size'] + 1,slot_bytes)
+		target = _slabWorker
+	else:
+		out = multiprocessing.Queue(param['feed_queue_size'])
+		target = _prefetchWorker
+
+	workers = []
+	for i in xrange(n_workers):
+		w = multiprocessing.Process(target=target,name='feed' + str(i),
+			args=(out,seeds[i],vid_info_list,param,do_augment,return_pose_vectors,return_class))
+		w.daemon = True
+		w.start()
+		workers.append(w)
+
+	if(param['feed_shared_memory']):
+		return _drainSlabRing(out,workers)
+	return _drainPrefetchQueue(out,workers)
+
+
+def transferExampleGenerator(vid_info_list,examples0,examples1,param):
+	#examples0 and examples1 are (n,2) arrays of example records of
+	#vid_info_list. The first frame of a pair from examples0 is rendered in
+	#the pose of the second frame of a pair from another video in examples1.
     
 	img_width = param['IMG_WIDTH']
 	img_height = param['IMG_HEIGHT']
@@ -174,24 +867,21 @@ def transferExampleGenerator(examples0,examples1,param):
 			for i in xrange(batch_size):
 				example0 = examples0[np.random.randint(0,len(examples0))] 
 				example1 = examples1[np.random.randint(0,len(examples1))] 
-				while(example0[-1] == example1[-1]):
+				while(example0[0]['vid'] == example1[1]['vid']):
 					example1 = examples1[np.random.randint(0,len(examples1))] 
 
-				I0,joints0,scale0,pos0 = readExampleInfo(example0[:32])
-				I1,joints1,scale1,pos1 = readExampleInfo(example1[32:64])
+				I0,joints0,scale0,pos0 = readExampleInfo(vid_info_list,example0[0])
+				I1,joints1,scale1,pos1 = readExampleInfo(vid_info_list,example1[1])
 
-				scale0 = scale_factor/example0[31]
-				scale1 = scale_factor/example1[31]
+				scale0 = scale_factor/scale0
+				scale1 = scale_factor/scale1
 
-				pos0 = np.array(example0[29:31])
 				I0,joints0 = centerAndScaleImage(I0,img_width,img_height,pos0,scale0,joints0)
 
-				I1 = cv2.resize(I1,(0,0),fx=scale1,fy=scale1)
-				joints1 = joints1 * scale1
-				offset = (joints0[10,:]+joints0[13,:] - joints1[10,:] - joints1[13,:])/2.0
-				joints1 += np.tile(offset,(14,1)) 
-				T = np.float32([[1,0,offset[0]],[0,1,offset[1]]])	
-				I1 = cv2.warpAffine(I1,T,(img_width,img_height))
+				#Place I1 so that its ankles line up with those of I0.
+				offset = (joints0[10,:]+joints0[13,:] - (joints1[10,:] + joints1[13,:])*scale1)/2.0
+				pos1 = (np.array([img_width-1.0,img_height-1.0])/2.0 - offset)/scale1
+				I1,joints1 = centerAndScaleImage(I1,img_width,img_height,pos1,scale1,joints1)
 
 				I0 = (I0/255.0 - 0.5)*2.0
 				I1 = (I1/255.0 - 0.5)*2.0
@@ -322,33 +1012,33 @@ def drawLimbsOnImage(I,joints,color=(0,0,255)):
 	return I
 '''
 
-def randScale(param):
-	rnd = np.random.rand()
+def randScale(param,rng=np.random):
+	rnd = rng.rand()
 	return ( param['scale_max']-param['scale_min']) * rnd + param['scale_min']
 
-def randRot( param ):
-	return (np.random.rand()-0.5)*2 * param['max_rotate_degree']
+def randRot(param,rng=np.random):
+	return (rng.rand()-0.5)*2 * param['max_rotate_degree']
 
-def randShift( param ):
+def randShift(param,rng=np.random):
 	shift_px = param['max_px_shift']
-	x_shift = int(shift_px * (np.random.rand()-0.5))
-	y_shift = int(shift_px * (np.random.rand()-0.5))
+	x_shift = int(shift_px * (rng.rand()-0.5))
+	y_shift = int(shift_px * (rng.rand()-0.5))
 	return x_shift, y_shift
 
-def randSat(param):
+def randSat(param,rng=np.random):
 	min_sat = 1 - param['max_sat_factor']
 	max_sat = 1 + param['max_sat_factor']
 
-	return np.random.rand()*(max_sat-min_sat) + min_sat
+	return rng.rand()*(max_sat-min_sat) + min_sat
 
 
-def randAugmentations(param):
+def randAugmentations(param,rng=np.random):
 
-	rflip = np.random.rand()
-	rscale = randScale(param)
-	rshift = randShift(param)
-	rdegree = randRot(param)
-	rsat = randSat(param)
+	rflip = rng.rand()
+	rscale = randScale(param,rng)
+	rshift = randShift(param,rng)
+	rdegree = randRot(param,rng)
+	rsat = randSat(param,rng)
 	
 	return rflip,rscale,rshift,rdegree,rsat
 
@@ -363,20 +1053,193 @@ def augment(I,joints,rflip,rscale,rshift,rdegree,rsat,img_height,img_width):
 	return I,joints
 
 
+def getWarpTransform(img_width,img_height,pos,scale,aug=None):
+	#3x3 matrix taking frame coordinates to output coordinates. It is the
+	#composition of centerAndScaleImage and, if aug=(rflip,rscale,rshift,
+	#rdegree,rsat) is given, augFlip, augScale, augShift and augRotate.
+
+	x_offset = (img_width-1.0)/2.0 - pos[0]*scale
+	y_offset = (img_height-1.0)/2.0 - pos[1]*scale
+	M = np.array([[scale,0,x_offset],[0,scale,y_offset],[0,0,1.0]])
+
+	if(aug is None):
+		return M
+
+	rflip,rscale,rshift,rdegree,rsat = aug
+
+	if(rflip >= 0.5):
+		F = np.array([[-1.0,0,img_width-1.0],[0,1.0,0],[0,0,1.0]])
+		M = np.dot(F,M)
+
+	S = np.array([[rscale,0,rshift[0]],[0,rscale,rshift[1]],[0,0,1.0]])
+	M = np.dot(S,M)
+
+	center = ( (img_width-1.0)/2.0, (img_height-1.0)/2.0 )
+	R = np.vstack((cv2.getRotationMatrix2D(center,rdegree,1),[0,0,1.0]))
+	return np.dot(R,M)
+
+def warpExample(I,joints,M,img_width,img_height,flip=False,A=None):
+	#Resamples I once with the matrix from getWarpTransform and moves the
+	#joints with it. A flipped warp also swaps left and right joints. If I 
+	#is not the full frame, A is the 3x3 matrix taking frame coordinates to
+	#I's coordinates; the joints stay in frame coordinates.
+
+	M_img = M
+	if(A is not None):
+		M_img = np.dot(M,np.linalg.inv(A))
+
+	I = cv2.warpAffine(I,M_img[0:2,:],(img_width,img_height))
+	joints = np.dot(joints,M[0:2,0:2].T) + M[0:2,2]
+
+	if(flip):
+		joints = swapLeftRightJoints(joints)
+
+	return I,joints
+
+def getSourceCorners(M,img_width,img_height):
+	#(4,2) frame points that the corners of the output window come from.
+	corners = np.array([[0,0,1.0],[img_width-1.0,0,1.0],
+						[0,img_height-1.0,1.0],[img_width-1.0,img_height-1.0,1.0]])
+	return np.dot(corners,np.linalg.inv(M).T)[:,0:2]
+
+def getSourceWindow(M,img_width,img_height,frame_width,frame_height,margin=0):
+	#Bounding box (x0,y0,x1,y1) of the frame pixels that the 3x3 frame to
+	#output matrix M maps into the output window, padded by margin frame
+	#pixels and clipped to the frame. x1 and y1 are exclusive.
+
+	p = getSourceCorners(M,img_width,img_height)
+
+	x0 = int(max(0,np.floor(np.amin(p[:,0]) - margin)))
+	y0 = int(max(0,np.floor(np.amin(p[:,1]) - margin)))
+	x1 = int(min(frame_width,np.ceil(np.amax(p[:,0]) + margin) + 1))
+	y1 = int(min(frame_height,np.ceil(np.amax(p[:,1]) + margin) + 1))
+
+	return x0,y0,max(x0,x1),max(y0,y1)
+
+def getCropPadding(param):
+	#Output pixels (x,y) on each side of the output window that a warp with
+	#augmentations from randAugmentations can bring into view, plus 2 for
+	#interpolation. Flips mirror the window, so both sides get the larger pad.
+	c = np.array([param['IMG_WIDTH']-1.0,param['IMG_HEIGHT']-1.0])/2.0
+	theta = np.deg2rad(param['max_rotate_degree'])
+	rot_extent = np.array([c[0]*np.cos(theta) + c[1]*np.sin(theta),
+						   c[0]*np.sin(theta) + c[1]*np.cos(theta)]) - c
+	shift = param['max_px_shift']/2.0
+
+	#Output points p come from (R^-1(p) - shift)/rscale of the centered window.
+	lo = (-rot_extent - shift)/param['scale_min']
+	hi = (2*c + rot_extent + shift)/param['scale_min']
+	pad = np.maximum(-lo,hi - 2*c)
+	return np.ceil(pad).astype(int) + 2
+
+def cropHoldsWindow(tile_shape,A,pos,scale,param):
+	#Whether a crop cache tile of tile_shape, with A taking frame coordinates
+	#to tile coordinates, holds the output window at pos and scale padded by
+	#getCropPadding, i.e. everything an augmented warp of the window reads.
+	img_width = param['IMG_WIDTH']
+	img_height = param['IMG_HEIGHT']
+	pad = getCropPadding(param)
+
+	M = getWarpTransform(img_width,img_height,pos,scale)
+	M[0:2,2] += pad
+	p = getSourceCorners(np.dot(M,np.linalg.inv(A)),img_width + 2*pad[0],img_height + 2*pad[1])
+
+	eps = 1e-6
+	return (np.all(p > -eps) and np.all(p[:,0] < tile_shape[1]-1+eps) and
+			np.all(p[:,1] < tile_shape[0]-1+eps))
+
+def getCropTilePadding(param):
+	#Padding of crop cache tiles: getCropPadding and param['crop_margin']
+	#more, for the windows of pairs set by the other frame's person.
+	return getCropPadding(param) + param['crop_margin']
+
+def getCropTransform(param,pos,scale):
+	#3x3 matrix taking frame coordinates to those of the crop cache tile of a
+	#frame whose person is at pos with getPersonScale scale: the centered
+	#output window of that frame alone, padded by getCropTilePadding.
+	pad = getCropTilePadding(param)
+	M = getWarpTransform(param['IMG_WIDTH'],param['IMG_HEIGHT'],pos,param['obj_scale_factor']/scale)
+	M[0:2,2] += pad
+	return M
+
+def buildCropCache(vid_file,crop_dir,param,n_procs=None,shard_bytes=2**30):
+	#Writes a crop cache for the videos of vid_file to crop_dir. Each frame is
+	#decoded once and warped to a tile around its person at the scale the
+	#feed would center it at, large enough for any augmentation and
+	#param['crop_margin'] more. The tiles are encoded in the format of their
+	#frames and packed into shards of shard_bytes (datareader.writeShards). Passing crop_dir/index.idx to createFeed then
+	#warps tiles instead of frames (datareader.CropFrameSource), or decodes
+	#the frame when a pair's window is not in its tile (cropHoldsWindow). The
+	#tiles depend on the image size, obj_scale_factor and augmentation
+	#ranges of param.
+
+	if(not os.path.isdir(crop_dir)):
+		os.makedirs(crop_dir)
+	index_file = os.path.join(crop_dir,'index.idx')
+
+	datareader.buildVidIndex(vid_file,index_file,n_procs)
+	header,index_arrays = datareader.readVidIndex(index_file)
+	arrays = [(name,np.array(index_arrays[name])) for name in ['bbox','X','scale','pos']]
+	del index_arrays
+
+	scales = arrays[2][1]
+	centers = arrays[3][1]
+	n_frames = scales.shape[0]
+	crop_A = np.zeros((n_frames,2,3))
+	for k in xrange(n_frames):
+		crop_A[k] = getCropTransform(param,centers[k],scales[k])[0:2]
+
+	pad = getCropTilePadding(param)
+	shape = [param['IMG_HEIGHT']+2*pad[1],param['IMG_WIDTH']+2*pad[0],3]
+
+	#Videos are encoded in parallel and written to the shards in order.
+	jobs = [(v['path'],v['ext'],v['n_frames'],shape,crop_A[v['offset']:v['offset']+v['n_frames']],
+			 scales[v['offset']:v['offset']+v['n_frames']],param) for v in header['vids']]
+	pool = multiprocessing.Pool(n_procs)
+	shards,crop_shard,crop_offset,crop_size = datareader.writeShards(crop_dir,header['vids'],
+		pool.imap(_encodeVideoCrops,jobs),n_frames,shard_bytes)
+	pool.close()
+	pool.join()
+
+	arrays += [('crop_A',crop_A),('crop_shard',crop_shard),('crop_offset',crop_offset),('crop_size',crop_size)]
+	datareader.writeVidIndex(index_file,header['vids'],arrays,{'crops': {'shards': shards,'shape': shape}})
+	return n_frames
+
+def _encodeVideoCrops(job):
+	vid_path,ext,n_frames,shape,crop_A,scales,param = job
+
+	tiles = []
+	for j in xrange(n_frames):
+		r = getDecodeReduction(param['obj_scale_factor']/scales[j],param)
+		I = datareader.readFrame(os.path.join(vid_path,str(j+1)+ext),r)
+		A = np.dot(np.vstack((crop_A[j],[0,0,1.0])),np.linalg.inv(getDecodeTransform(r)))
+		tiles.append(cv2.imencode(ext,cv2.warpAffine(I,A[0:2,:],(shape[1],shape[0])))[1].tostring())
+	return tiles
+
 def centerAndScaleImage(I,img_width,img_height,pos,scale,joints):
 
-	I = cv2.resize(I,(0,0),fx=scale,fy=scale)
+	#Only the part of I that lands in the output window (plus a couple of
+	#output pixels for interpolation) is resized, so the cost no longer
+	#depends on the frame size.
+	M = getWarpTransform(img_width,img_height,pos,scale)
+	x0,y0,x1,y1 = getSourceWindow(M,img_width,img_height,I.shape[1],I.shape[0],2.0/scale)
+
 	joints = joints * scale
 
 	x_offset = (img_width-1.0)/2.0 - pos[0]*scale
 	y_offset = (img_height-1.0)/2.0 - pos[1]*scale
 
-	T = np.float32([[1,0,x_offset],[0,1,y_offset]])	
-	I = cv2.warpAffine(I,T,(img_width,img_height))
-
 	joints[:,0] += x_offset
 	joints[:,1] += y_offset
 
+	if(x1 == x0 or y1 == y0):
+		return np.zeros((img_height,img_width,I.shape[2]),dtype=I.dtype),joints
+
+	I = cv2.resize(I[y0:y1,x0:x1],(0,0),fx=scale,fy=scale)
+
+	T = np.float32([[1,0,x_offset + x0*scale],[0,1,y_offset + y0*scale]])	
+	I = cv2.warpAffine(I,T,(img_width,img_height))
+
 	return I,joints
 
 def augJointShift(joints,max_joint_shift):
@@ -390,7 +1253,11 @@ def augFlip(I,rflip,joints):
 	
 	I = np.fliplr(I)
 	joints[:,0] = I.shape[1] - 1 - joints[:,0]
+	joints = swapLeftRightJoints(joints)
+	
+	return I,joints
 
+def swapLeftRightJoints(joints):
 	right = [2,3,4,8,9,10]
 	left = [5,6,7,11,12,13]
 
@@ -398,8 +1265,8 @@ def augFlip(I,rflip,joints):
 		tmp = np.copy(joints[right[i],:])
 		joints[right[i],:] = np.copy(joints[left[i],:])
 		joints[left[i],:] = tmp
-	
-	return I,joints
+
+	return joints
 
 def augScale(I,scale_rand, joints):
 	I = cv2.resize(I,(0,0),fx=scale_rand,fy=scale_rand)
@@ -482,22 +1349,56 @@ def makeVelocityHeatmap(height,width,joints0,joints1,sigma):
 '''
 
 def makeJointHeatmaps(height,width,joints,sigma,pose_dn):
-
+	return makeJointHeatmapsBatch(height,width,np.expand_dims(joints,0),sigma,pose_dn)[0]
+
+
+#1D pixel coordinates for each heatmap resolution, keyed by (height,width).
+heatmap_grids = {}
+
+def getHeatmapGrids(height,width):
+	if((height,width) not in heatmap_grids):
+		heatmap_grids[(height,width)] = (np.arange(width,dtype=np.float32),
+										 np.arange(height,dtype=np.float32))
+	return heatmap_grids[(height,width)]
+
+def makeJointHeatmapsBatch(height,width,joints,sigma,pose_dn,out=None):
+	#Renders a (B,n_joints,2) joint array into (B,height/pose_dn,width/pose_dn,n_joints)
+	#float32 heatmaps, written into out if given. The joint Gaussians are axis aligned, so each map is the
+	#outer product of a 1D Gaussian in y and one in x. Joints on or outside 
+	#the border get an empty map, as in the per-joint version.
+	records = makeJointRecords(height,width,joints,pose_dn)
+	return densifyJointRecords(records,height/pose_dn,width/pose_dn,sigma,out)
+
+def makeJointRecords(height,width,joints,pose_dn,out=None):
+	#The (B,n_joints,3) float32 records (x,y,valid) that the heatmaps of
+	#makeJointHeatmapsBatch are rendered from: the joint centers on the pose
+	#map grid and whether they are inside its border.
 	height = height/pose_dn
 	width = width/pose_dn
-	sigma = sigma**2
-	joints = joints/pose_dn
-
-	H = np.zeros((height,width,14)) #len(limbs)-1))
-
-	for i in xrange(H.shape[2]):
-		if(joints[i,0] <= 0 or joints[i,1] <= 0  or joints[i,0] >= width-1 or
-			joints[i,1] >= height-1):
-			continue
-	
-		H[:,:,i] = makeGaussianMap(width,height,joints[i,:],sigma,sigma,0.0)
-
-	return H
+	joints = np.asarray(joints,dtype=np.float32)/pose_dn
+
+	if(out is None):
+		out = np.zeros(joints.shape[0:2] + (3,),dtype=np.float32)
+	jx = joints[:,:,0]
+	jy = joints[:,:,1]
+	out[:,:,0:2] = joints
+	out[:,:,2] = ((jx > 0) & (jy > 0) & (jx < width-1) & (jy < height-1))
+	return out
+
+def densifyJointRecords(records,height,width,sigma,out=None):
+	#Renders makeJointRecords records into (B,height,width,n_joints) float32
+	#heatmaps on the pose map grid, written into out if given.
+	xv,yv = getHeatmapGrids(height,width)
+
+	jx = records[:,:,0:1]
+	jy = records[:,:,1:2]
+	gx = np.exp(-(xv-jx)**2/np.float32(2*sigma**2))
+	gy = np.exp(-(yv-jy)**2/np.float32(2*sigma**2))
+	gx *= records[:,:,2:3]
+
+	if(out is None):
+		return np.einsum('bjh,bjw->bhwj',gy,gx)
+	return np.einsum('bjh,bjw->bhwj',gy,gx,out=out)
 
 def makeGaussianMap(img_width,img_height,center,sigma_x,sigma_y,theta):
 
@@ -513,69 +1414,183 @@ def makeGaussianMap(img_width,img_height,center,sigma_x,sigma_y,theta):
 			c*(yv-center[1])*(yv-center[1])))
 
 
-def makeLimbMasks(joints,img_width,img_height):
+def makeLimbMasks(joints,img_width,img_height,cutoff=0.0):
+	#Rotated Gaussian for each limb, normalized so that its largest value on
+	#the pixel grid is ~1. Values below cutoff are left at zero.
 
-	n_limbs = len(limbs)
-	n_joints = joints.shape[0]
+	mask = np.zeros((img_height,img_width,len(limbs)),dtype=np.float32)
+	for l,(win,x0,y0) in enumerate(makeLimbMasksWindows(joints,img_width,img_height,cutoff)):
+		mask[y0:y0+win.shape[0],x0:x0+win.shape[1],l] = win
+	return mask
 
-	mask = np.zeros((img_height,img_width,n_limbs))
 
-	#Gaussian sigma perpendicular to the limb axis. I hardcoded
-	#reasonable sigmas for now.
-	sigma_perp = np.array([11,11,11,11,11,11,11,11,11,13])**2	 
+def makeLimbMaskPriors(joints,img_width,img_height,cutoff=0.0,out=None,dn=1):
+	#The log-prior fed to network_fgbg: background (1 - largest limb mask)
+	#in channel 0 followed by the limb masks, all as log(mask + 1e-10).
+	#Outside its window a limb's mask is zero, so the logs only have to be
+	#taken inside the windows. Written into out if given. With dn > 1 it is
+	#rendered on the image grid downsampled by dn, which network_fgbg upsamples.
+
+	img_width = img_width/dn
+	img_height = img_height/dn
+	priors = out
+	if(priors is None):
+		priors = np.empty((img_height,img_width,len(limbs)+1),dtype=np.float32)
+	priors[:,:,0] = np.log(1.0 + 1e-10)
+	priors[:,:,1:] = np.log(1e-10)
+
+	windows = makeLimbMasksWindows(joints,img_width,img_height,cutoff,dn)
+	bx0 = min([x0 for win,x0,y0 in windows])
+	by0 = min([y0 for win,x0,y0 in windows])
+	bx1 = max([x0 + win.shape[1] for win,x0,y0 in windows])
+	by1 = max([y0 + win.shape[0] for win,x0,y0 in windows])
+
+	#Largest limb mask over the box around all windows, for the background.
+	fg = np.zeros((max(by1-by0,0),max(bx1-bx0,0)))
+	for l,(win,x0,y0) in enumerate(windows):
+		h = win.shape[0]
+		w = win.shape[1]
+		priors[y0:y0+h,x0:x0+w,l+1] = np.log(win + 1e-10)
+		fg_win = fg[y0-by0:y0-by0+h,x0-bx0:x0-bx0+w]
+		np.maximum(fg_win,win,out=fg_win)
+
+	priors[by0:by1,bx0:bx1,0] = np.log(np.maximum(1.0 - fg,0) + 1e-10)
+	return priors
+
+
+#Joints whose mean gives each end of a limb. The torso runs from the
+#middle of the shoulders to the middle of the hips.
+limb_top = np.array([[l[0],l[0]] if len(l) == 2 else [l[0],l[1]] for l in limbs])
+limb_bot = np.array([[l[1],l[1]] if len(l) == 2 else [l[2],l[3]] for l in limbs])
+
+#Gaussian sigma perpendicular to the limb axis. I hardcoded
+#reasonable sigmas for now.
+limb_sigma_perp = np.array([11,11,11,11,11,11,11,11,11,13])**2	 
+
+def getLimbGaussians(joints,dn=1):
+	#Center and quadratic form coefficients (a,b,c) of every limb Gaussian,
+	#with the same parameterization as makeGaussianMap. On the grid
+	#downsampled by dn (pixel i at image pixel i*dn, as resize_bilinear
+	#upsamples) the joints are at joints/dn and the variances are /dn^2.
+
+	p0 = np.mean(joints[limb_top,:],axis=1)/dn
+	p1 = np.mean(joints[limb_bot,:],axis=1)/dn
+	center = (p0 + p1)/2.0
+
+	sigma_x = np.maximum(5.0/dn**2,np.sum((p1 - p0)**2,axis=1)/1.5)
+	sigma_y = limb_sigma_perp/float(dn**2)
+	theta = np.arctan2(p1[:,1] - p0[:,1], p0[:,0] - p1[:,0])
 
-	for i in xrange(n_limbs):	
-		n_joints_for_limb = len(limbs[i])
-		p = np.zeros((n_joints_for_limb,2))
-
-		for j in xrange(n_joints_for_limb):
-			p[j,:] = [joints[limbs[i][j],0],joints[limbs[i][j],1]]
+	a = np.cos(theta)**2/(2*sigma_x) + np.sin(theta)**2/(2*sigma_y)
+	b = -np.sin(2*theta)/(4*sigma_x) + np.sin(2*theta)/(4*sigma_y)
+	c = np.sin(theta)**2/(2*sigma_x) + np.cos(theta)**2/(2*sigma_y)
 
-		if(n_joints_for_limb == 4):
-			p_top = np.mean(p[0:2,:],axis=0)
-			p_bot = np.mean(p[2:4,:],axis=0)
-			p = np.vstack((p_top,p_bot))
+	return center,a,b,c
+
+def getGaussianRectMin(center,a,b,c,img_width,img_height):
+	#Smallest value of the quadratic form a*dx^2 + 2*b*dx*dy + c*dy^2 over the
+	#image rectangle, i.e. -log of the Gaussian's largest value in the image.
+	#It is either at the center or on one of the four edges, where it has a
+	#closed form. This is a lower bound for the minimum over the pixel grid.
+
+	def q(x,y):
+		dx = x - center[:,0]
+		dy = y - center[:,1]
+		return a*dx*dx + 2*b*dx*dy + c*dy*dy
+
+	x_max = img_width - 1.0
+	y_max = img_height - 1.0
+
+	qs = [q(np.clip(center[:,0],0,x_max),np.clip(center[:,1],0,y_max))]
+	for xe in [0,x_max]:
+		qs.append(q(xe,np.clip(center[:,1] - b*(xe-center[:,0])/c,0,y_max)))
+	for ye in [0,y_max]:
+		qs.append(q(np.clip(center[:,0] - b*(ye-center[:,1])/a,0,x_max),ye))
+
+	return np.amin(qs,axis=0)
+
+def makeLimbMasksWindows(joints,img_width,img_height,cutoff=0.0,dn=1):
+	#Evaluates every limb Gaussian only over the smallest pixel window that
+	#holds its values above cutoff. Returns a list with the (h,w) window of
+	#each limb and its top-left corner in the image. img_width and
+	#img_height are those of the grid downsampled by dn.
+
+	center,a,b,c = getLimbGaussians(joints,dn)
+	n_limbs = len(a)
+
+	if(cutoff > 0):
+		#Relative to the largest value in the image, the region above cutoff
+		#is the ellipse a*dx^2+2*b*dx*dy+c*dy^2 < q_max, whose bounding box has
+		#half sizes sqrt(q_max*c/det) and sqrt(q_max*a/det).
+		peak = np.exp(-getGaussianRectMin(center,a,b,c,img_width,img_height))
+		q_max = np.maximum(-np.log(cutoff*(peak + 1e-6)),0)
+		det = a*c - b*b
+		half_w = np.sqrt(q_max*c/det)
+		half_h = np.sqrt(q_max*a/det)
+		x0 = np.clip(np.floor(center[:,0] - half_w),0,img_width).astype(int)
+		x1 = np.clip(np.ceil(center[:,0] + half_w) + 1,0,img_width).astype(int)
+		y0 = np.clip(np.floor(center[:,1] - half_h),0,img_height).astype(int)
+		y1 = np.clip(np.ceil(center[:,1] + half_h) + 1,0,img_height).astype(int)
+		x1 = np.maximum(x0,x1)
+		y1 = np.maximum(y0,y1)
+	else:
+		x0 = y0 = np.zeros(n_limbs,dtype=int)
+		x1 = np.full(n_limbs,img_width,dtype=int)
+		y1 = np.full(n_limbs,img_height,dtype=int)
 
-		center = np.mean(p,axis=0)		
+	windows = []
+	for l in xrange(n_limbs):
+		#Kept in float64: the background prior takes log(1 - mask) and the
+		#masks come within 1e-6 of 1 at the limb centers.
+		dx = np.arange(x0[l],x1[l],dtype=np.float64) - center[l,0]
+		dy = np.arange(y0[l],y1[l],dtype=np.float64)[:,None] - center[l,1]
 
-		sigma_parallel = np.max([5,(np.sum((p[1,:] - p[0,:])**2))/1.5])
-		theta = np.arctan2(p[1,1] - p[0,1], p[0,0] - p[1,0])
+		#-q is built in place from the small per-row and per-column terms.
+		win = (-2*b[l]*dx)*dy
+		win -= a[l]*dx*dx
+		win -= c[l]*dy*dy
+		np.exp(win,out=win)
 
-		mask_i = makeGaussianMap(img_width,img_height,center,sigma_parallel,sigma_perp[i],theta)
-		mask[:,:,i] = mask_i/(np.amax(mask_i) + 1e-6)
-		
-	return mask
+		#The brightest pixel of the limb is inside its window, so its max
+		#over the window is the same as the old max over the whole image.
+		if(win.size > 0):
+			win /= np.amax(win) + 1e-6
 
+		if(cutoff > 0):
+			win[win < cutoff] = 0
 
-def getLimbTransforms(joints1,joints2): 
-	
-	n_limbs = len(limbs)
-	n_joints = joints1.shape[0]
+		windows.append((win,x0[l],y0[l]))
 
-	Ms = np.zeros((2,3,10))
-	ctr = 0
-	for i in xrange(n_limbs):	
+	return windows
 
-		n_joints_for_limb = len(limbs[i])
-		p1 = np.zeros((n_joints_for_limb,2))
-		p2 = np.zeros((n_joints_for_limb,2))
-
-		for j in xrange(n_joints_for_limb):
-			p1[j,:] = [joints1[limbs[i][j],0],joints1[limbs[i][j],1]]
-			p2[j,:] = [joints2[limbs[i][j],0],joints2[limbs[i][j],1]]			
-
-		tform = transformations.make_similarity(p2,p1,False)
-		Ms[:,:,ctr] = np.array([[tform[1],-tform[3],tform[0]],[tform[3],tform[1],tform[2]]])
-		ctr+=1
-
-		'''
-		if(i >= 1 and i <= 4):
-			tform = transformations.make_similarity(p2,p1,True)	
-			Ms[:,:,ctr] = np.array([[tform[1],tform[3],tform[0]],[tform[3],-tform[1],tform[2]]])
-			ctr+=1
-		'''
-		
-		#M = np.array([[tform[1], tform[2], tform[0]],[tform[5],tform[6],tform[4]]])
-		#Ms[:,:,i] = M
+def getLimbTransforms(joints1,joints2): 
+	return getLimbTransformsBatch(np.expand_dims(joints1,0),np.expand_dims(joints2,0))[0]
+
+
+#Joint indices of the two-point limbs and of the torso, in the order of limbs.
+limb_pairs = np.array([l for l in limbs if len(l) == 2])
+limb_torso = np.array([l for l in limbs if len(l) == 4])
+
+def getLimbTransformsBatch(joints1,joints2):
+	#Similarity transforms taking each limb of joints2 onto the same limb of
+	#joints1, for (B,n_joints,2) joint arrays. Returns (B,2,3,n_limbs) in the
+	#layout of X_trans[:,:,:,1:].
+
+	params = np.concatenate((
+		transformations.make_similarity_batch(joints2[:,limb_pairs,:],joints1[:,limb_pairs,:]),
+		transformations.make_similarity_batch(joints2[:,limb_torso,:],joints1[:,limb_torso,:])),axis=1)
+
+	a0 = params[:,:,0]
+	a1 = params[:,:,1]
+	b0 = params[:,:,2]
+	b1 = params[:,:,3]
+
+	Ms = np.zeros((joints1.shape[0],2,3,len(limbs)))
+	Ms[:,0,0,:] = a1
+	Ms[:,0,1,:] = -b1
+	Ms[:,0,2,:] = a0
+	Ms[:,1,0,:] = b1
+	Ms[:,1,1,:] = a1
+	Ms[:,1,2,:] = b0
 
 	return Ms
@@ -3,30 +3,250 @@ import cv2
 import scipy.io as sio
 import os
 import json
+import threading
+import multiprocessing
+import itertools
+from collections import OrderedDict
 
-def makeVidInfoList(vid_file):
-	
+class FrameCache(object):
+	#LRU cache of decoded frames keyed by path, holding at most max_bytes of
+	#pixel data. Each process has its own frames, but the hit and miss
+	#counters are shared, so a cache created before the feed workers fork
+	#reports totals over all of them. Cached frames are read-only.
+
+	def __init__(self,max_bytes):
+		self.max_bytes = max_bytes
+		self.n_bytes = 0
+		self.frames = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = multiprocessing.Value('l',0)
+		self.misses = multiprocessing.Value('l',0)
+
+	def get(self,key,load):
+		with self.lock:
+			I = self.frames.pop(key,None)
+			if(I is not None):
+				self.frames[key] = I
+
+		if(I is not None):
+			with self.hits.get_lock():
+				self.hits.value += 1
+			return I
+
+		with self.misses.get_lock():
+			self.misses.value += 1
+
+		I = load()
+		if(I is None or I.nbytes > self.max_bytes):
+			return I
+		I.flags.writeable = False
+
+		with self.lock:
+			if(key not in self.frames):
+				self.frames[key] = I
+				self.n_bytes += I.nbytes
+			while(self.n_bytes > self.max_bytes):
+				_,old = self.frames.popitem(last=False)
+				self.n_bytes -= old.nbytes
+
+		return I
+
+	def stats(self):
+		return {'hits': self.hits.value, 'misses': self.misses.value,
+				'frames': len(self.frames), 'bytes': self.n_bytes}
+
+
+frame_cache = None
+
+def setFrameCache(max_bytes):
+	#Enables (max_bytes > 0) or disables the frame cache used by readFrame.
+	global frame_cache
+	frame_cache = None
+	if(max_bytes > 0):
+		frame_cache = FrameCache(max_bytes)
+	return frame_cache
+
+#imread flags that decode at 1/1, 1/2, 1/4 and 1/8 of the full resolution.
+reduced_read_flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+					  4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+#Frame sources by frame directory. Frames of videos without a source are
+#read from their files.
+frame_sources = {}
+
+def addFrameSource(source):
+	#Frames of the videos in source.vid_paths are then read with
+	#source.read(path,reduce), e.g. from a ShardFrameSource.
+	for vid_path in source.vid_paths:
+		frame_sources[vid_path] = source
+	return source
+
+def readFrame(path,reduce=1):
+	#Decodes a frame, optionally at 1/reduce of its resolution. JPEGs are
+	#then scaled during decoding, which is much cheaper than a full decode.
+	flags = reduced_read_flags[reduce]
+	source = frame_sources.get(os.path.dirname(path))
+	if(source is None):
+		load = lambda: cv2.imread(path,flags)
+	else:
+		load = lambda: source.read(path,reduce)
+
+	if(frame_cache is None):
+		return load()
+	return frame_cache.get((path,reduce),load)
+
+
+def getPersonScales(X):
+	#datageneration.getPersonScale for every frame of a (14,2,n_frames) joint
+	#array at once.
+	joints = X - 1.0
+	torso_size = -joints[0,1,:] + (joints[8,1,:] + joints[11,1,:])/2.0
+	peak_to_peak = np.ptp(joints[:,1,:],axis=0)
+	rcalf_size = np.sqrt((joints[9,1,:] - joints[10,1,:])**2 + (joints[9,0,:] - joints[10,0,:])**2)
+	lcalf_size = np.sqrt((joints[12,1,:] - joints[13,1,:])**2 + (joints[12,0,:] - joints[13,0,:])**2)
+	calf_size = (lcalf_size + rcalf_size)/2.0
+
+	size = np.amax([2.5 * torso_size,calf_size*5,peak_to_peak*1.1],axis=0)
+	return (size/200.0)
+
+def getBoxCenters(box):
+	return np.stack((box[:,0] + box[:,2]/2.0, box[:,1] + box[:,3]/2.0),axis=1)
+
+def makeVidInfo(info,box,X,vid_path,ext,scales=None,centers=None,class_id=-1):
+	#One vid_info_list entry: [info,bbox,X,frame dir,frame extension,person
+	#scale per frame,bbox center per frame,class id]. The scales and centers
+	#are computed here for the whole video unless they are given.
+	if(scales is None):
+		scales = getPersonScales(X)
+	if(centers is None):
+		centers = getBoxCenters(box)
+	return [info,box,X,vid_path,ext,scales,centers,class_id]
+
+#Examples are records of example_dtype. Instead of its path, a record holds
+#the index of its video in a vid_info_list and its frame number, so the
+#vid_info_list is the string table that stores each frame directory and
+#extension once. An array of records takes a fixed 256 bytes per frame and
+#its fields are sliced as views.
+example_dtype = np.dtype([('vid',np.int32),('frame',np.int32),('joints',np.float64,(14,2)),
+	('pos',np.float64,(2,)),('scale',np.float64)])
+
+def makeExamples(vid_info_list,vid,frames):
+	#Records for the given frames of video vid of vid_info_list.
+	X,vid_path,ext,scales,centers = vid_info_list[vid][2:7]
+	frames = np.asarray(frames,dtype=np.int64)
+
+	examples = np.zeros(len(frames),dtype=example_dtype)
+	examples['vid'] = vid
+	examples['frame'] = frames
+	examples['joints'] = np.transpose(X[:,:,frames],(2,0,1)) - 1.0
+	examples['scale'] = scales[frames]
+	examples['pos'] = centers[frames]
+	return examples
+
+def getExamplePath(vid_info_list,example):
+	vid_path,ext = vid_info_list[int(example['vid'])][3:5]
+	return os.path.join(vid_path,str(example['frame']+1)+ext)
+
+def getInfoName(vid_path):
+	#Annotations of <root>/frames/<vid> are in <root>/info/<vid>.mat
+	path,vid_name = os.path.split(vid_path)
+	return path[:-6] + 'info/' + vid_name + '.mat'
+
+def getFrameExt(vid_path):
+	#Frames are 1.jpg, 2.jpg, ... or 1.png, 2.png, ...
+	if(os.path.isfile(os.path.join(vid_path,'1.jpg'))):
+		return '.jpg'
+	return '.png'
+
+def parseVidLine(vid_line):
+	#A line of a video list is a frame directory, optionally followed by the
+	#class id of the video ("<dir> <class>"). Videos without one are class -1.
+	fields = vid_line.rsplit(None,1)
+	if(len(fields) == 2 and fields[1].isdigit()):
+		return (fields[0],int(fields[1]))
+	return (vid_line,-1)
+
+def readVidList(vid_file):
+	#Frame directories and class ids of the videos of vid_file.
 	f = open(vid_file)
 	vid_lines = f.read().splitlines()
 	f.close()
+
+	vids = [parseVidLine(l) for l in vid_lines]
+	return ([v[0] for v in vids],[v[1] for v in vids])
+
+def loadVidInfo(vid_file,max_vids=0):
+	#vid_info_list from either a video list or an index built by buildVidIndex.
+	#With max_vids > 0 a video list is loaded lazily by LazyVidInfoList. An
+	#index never needs that: its arrays are memory-mapped and only the pages
+	#that are sampled from are ever read.
+	if(vid_file.endswith('.idx')):
+		return loadVidIndex(vid_file)
+	if(max_vids > 0):
+		vid_paths,classes = readVidList(vid_file)
+		return LazyVidInfoList(vid_paths,max_vids,classes)
+	return makeVidInfoList(vid_file)
+
+
+class LazyVidInfoList(object):
+	#Stands in for the list from makeVidInfoList, but only holds the video
+	#paths up front. A video's annotations are read from its .mat file the
+	#first time it is indexed and kept in an LRU of at most max_vids videos,
+	#so startup time and memory no longer grow with the number of videos.
+
+	def __init__(self,vid_paths,max_vids,classes=None):
+		self.vid_paths = vid_paths
+		self.classes = classes
+		if(classes is None):
+			self.classes = [-1]*len(vid_paths)
+		self.max_vids = max_vids
+		self.vids = OrderedDict()
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.vid_paths)
+
+	def __getitem__(self,i):
+		if(i < 0 or i >= len(self.vid_paths)):
+			raise IndexError('video index out of range')
+
+		with self.lock:
+			vid_info = self.vids.pop(i,None)
+			if(vid_info is not None):
+				self.vids[i] = vid_info
+				return vid_info
+
+		vid_path = self.vid_paths[i]
+		box,X = loadVidAnnotations(getInfoName(vid_path))
+		vid_info = makeVidInfo(None,box,np.transpose(X,(1,2,0)),vid_path,getFrameExt(vid_path),
+							   class_id=self.classes[i])
+
+		with self.lock:
+			self.vids[i] = vid_info
+			while(len(self.vids) > self.max_vids):
+				self.vids.popitem(last=False)
+
+		return vid_info
+
+def makeVidInfoList(vid_file):
 	
-	n_vids = len(vid_lines)
+	vid_paths,classes = readVidList(vid_file)
+	
+	n_vids = len(vid_paths)
 
 	vid_info = []
 		
 	for i in xrange(n_vids):
-		vid_line = vid_lines[i] #np.random.randint(0,n_vids)]
-		vid_path = vid_line
-		#class_id = vid_line[-1]
+		vid_path = vid_paths[i] #np.random.randint(0,n_vids)]
+		class_id = classes[i]
 
-		path,vid_name = os.path.split(vid_path)
-		info_name = path[:-6] + 'info/' + vid_name + '.mat'
+		info_name = getInfoName(vid_path)
 
 		info = sio.loadmat(info_name)		
 		box = info['data']['bbox'][0][0]
 		X = info['data']['X'][0][0]
 
-		vid_info.append([info,box,X,vid_path])
+		vid_info.append(makeVidInfo(info,box,X,vid_path,getFrameExt(vid_path),class_id=class_id))
 
 		'''
 		n_frames = X.shape[2]
@@ -48,6 +268,416 @@ def makeVidInfoList(vid_file):
 	return vid_info
 
 
+#Annotation index: all videos' bbox and X arrays packed into one file that
+#is opened with a single memory map. The file is the magic string, the
+#length of a JSON header, the header, then the arrays at 64-byte aligned
+#offsets. The header lists, per video, its frame directory, frame
+#extension, .mat file, mtime and class id, and the range of rows it owns in the
+#(n_frames_total,4) bbox, (n_frames_total,14,2) joint, (n_frames_total,)
+#person scale and (n_frames_total,2) bbox center arrays.
+index_magic = 'P2IINDEX'
+
+def loadVidAnnotations(info_name):
+	info = sio.loadmat(info_name)
+	box = info['data']['bbox'][0][0]
+	X = info['data']['X'][0][0]
+	return (box.astype(np.float64),np.transpose(X,(2,0,1)).astype(np.float64))
+
+def readVidIndex(index_file):
+	#Returns the header and a dict with memory-mapped views of the arrays.
+	data = np.memmap(index_file,dtype=np.uint8,mode='r')
+	n_magic = len(index_magic)
+	if(data[0:n_magic].tostring() != index_magic):
+		raise ValueError(index_file + ' is not a video annotation index')
+
+	n_header = int(data[n_magic:n_magic+8].view('<u8')[0])
+	header = json.loads(data[n_magic+8:n_magic+8+n_header].tostring())
+
+	arrays = {}
+	for name,desc in header['arrays'].items():
+		dtype = np.dtype(str(desc['dtype']))
+		n_bytes = int(np.prod(desc['shape']))*dtype.itemsize
+		arrays[name] = data[desc['offset']:desc['offset']+n_bytes].view(dtype).reshape(desc['shape'])
+
+	return header,arrays
+
+def loadVidIndex(index_file):
+	#vid_info_list whose bbox and X entries are views into the index file.
+	header,arrays = readVidIndex(index_file)
+
+	vid_info = []
+	for v in header['vids']:
+		a = v['offset']
+		b = a + v['n_frames']
+		X = np.transpose(arrays['X'][a:b],(1,2,0))
+		vid_info.append(makeVidInfo(None,arrays['bbox'][a:b],X,v['path'],v['ext'],
+									arrays['scale'][a:b],arrays['pos'][a:b],v.get('class',-1)))
+
+	return vid_info
+
+def buildVidIndex(vid_file,index_file,n_procs=None):
+	#Writes the annotation index for the videos listed in vid_file. The .mat
+	#files are read in parallel. If index_file already exists, videos whose
+	#.mat file has the same mtime are copied from it instead of being reread.
+
+	vid_paths,classes = readVidList(vid_file)
+	info_names = [getInfoName(v) for v in vid_paths]
+	mtimes = [os.path.getmtime(f) for f in info_names]
+
+	old = {}
+	if(os.path.isfile(index_file)):
+		old_header,old_arrays = readVidIndex(index_file)
+		for v in old_header['vids']:
+			old[v['info']] = v
+
+	stale = [i for i in xrange(len(vid_paths)) if(info_names[i] not in old or 
+			 old[info_names[i]]['mtime'] != mtimes[i])]
+
+	pool = multiprocessing.Pool(n_procs)
+	loaded = dict(zip(stale,pool.map(loadVidAnnotations,[info_names[i] for i in stale])))
+	pool.close()
+	pool.join()
+
+	boxes = []
+	joints = []
+	all_scales = []
+	all_centers = []
+	vids = []
+	offset = 0
+	for i in xrange(len(vid_paths)):
+		if(i in loaded):
+			box,X = loaded[i]
+			scales = getPersonScales(np.transpose(X,(1,2,0)))
+			centers = getBoxCenters(box)
+		else:
+			v = old[info_names[i]]
+			box = np.array(old_arrays['bbox'][v['offset']:v['offset']+v['n_frames']])
+			X = np.array(old_arrays['X'][v['offset']:v['offset']+v['n_frames']])
+			scales = np.array(old_arrays['scale'][v['offset']:v['offset']+v['n_frames']])
+			centers = np.array(old_arrays['pos'][v['offset']:v['offset']+v['n_frames']])
+
+		vids.append({'path': vid_paths[i], 'ext': getFrameExt(vid_paths[i]), 'info': info_names[i],
+					 'mtime': mtimes[i], 'offset': offset, 'n_frames': X.shape[0], 'class': classes[i]})
+		boxes.append(box)
+		joints.append(X)
+		all_scales.append(scales)
+		all_centers.append(centers)
+		offset += X.shape[0]
+
+	arrays = [('bbox',np.concatenate(boxes)),('X',np.concatenate(joints)),
+			  ('scale',np.concatenate(all_scales)),('pos',np.concatenate(all_centers))]
+	writeVidIndex(index_file,vids,arrays)
+	return len(stale)
+
+def writeVidIndex(index_file,vids,arrays,extra=None):
+
+	#Array offsets depend on the header length, which depends on the offsets,
+	#so reserve room for the offsets' digits before computing them.
+	desc = dict((name,{'dtype': a.dtype.str,'shape': list(a.shape),'offset': 10**15}) 
+				for name,a in arrays)
+	header = {'vids': vids,'arrays': desc}
+	if(extra is not None):
+		header.update(extra)
+
+	n_header = len(json.dumps(header))
+	offset = len(index_magic) + 8 + n_header
+	for name,a in arrays:
+		offset = (offset + 63)//64*64
+		desc[name]['offset'] = offset
+		offset += a.nbytes
+
+	header = json.dumps(header)
+	header += ' '*(n_header - len(header))
+
+	tmp_file = index_file + '.tmp'
+	f = open(tmp_file,'wb')
+	f.write(index_magic)
+	f.write(np.array([n_header],dtype='<u8').tostring())
+	f.write(header)
+	for name,a in arrays:
+		f.write('\0'*(desc[name]['offset'] - f.tell()))
+		f.write(np.ascontiguousarray(a).tostring())
+	f.close()
+	os.rename(tmp_file,index_file)
+
+
+#Frame shards: buildFrameShards copies the encoded frame files of every
+#video, back to back, into a few large shard files, so that reading a frame
+#no longer opens a file. The shard directory holds the shards and an
+#annotation index, index.idx, whose header also lists the shard files and
+#which has three more per-frame arrays: the shard, byte offset and byte size
+#of each frame. A video's frames are never split across shards.
+
+def buildFrameShards(vid_file,shard_dir,shard_bytes=2**30,n_procs=None):
+	#Returns the number of shards written. A new shard is started once the
+	#current one holds at least shard_bytes.
+
+	if(not os.path.isdir(shard_dir)):
+		os.makedirs(shard_dir)
+	index_file = os.path.join(shard_dir,'index.idx')
+
+	buildVidIndex(vid_file,index_file,n_procs)
+	header,index_arrays = readVidIndex(index_file)
+	arrays = [(name,np.array(index_arrays[name])) for name in ['bbox','X','scale','pos']]
+	del index_arrays
+
+	n_frames = arrays[0][1].shape[0]
+	vid_frames = (map(readFileBytes,[os.path.join(v['path'],str(j+1)+v['ext']) for j in xrange(v['n_frames'])])
+				  for v in header['vids'])
+	shards,frame_shard,frame_offset,frame_size = writeShards(shard_dir,header['vids'],vid_frames,n_frames,shard_bytes)
+
+	arrays += [('frame_shard',frame_shard),('frame_offset',frame_offset),('frame_size',frame_size)]
+	writeVidIndex(index_file,header['vids'],arrays,{'shards': shards})
+	return len(shards)
+
+def readFileBytes(path):
+	f = open(path,'rb')
+	data = f.read()
+	f.close()
+	return data
+
+def writeShards(shard_dir,vids,vid_frames,n_rows,shard_bytes=2**30):
+	#Packs the encoded frames of the videos of an index header's vids into
+	#shards in shard_dir. vid_frames gives, for each video in turn, a list of
+	#its frames' bytes. Returns the shard names and the shard, byte offset
+	#and byte size of each of the n_rows rows.
+	row_shard = np.zeros(n_rows,dtype='<i4')
+	row_offset = np.zeros(n_rows,dtype='<u8')
+	row_size = np.zeros(n_rows,dtype='<u8')
+
+	shards = []
+	f = None
+	for v,frames in itertools.izip(vids,vid_frames):
+		if(f is None or f.tell() >= shard_bytes):
+			if(f is not None):
+				f.close()
+			shards.append('%05d.shard' % len(shards))
+			f = open(os.path.join(shard_dir,shards[-1]),'wb')
+
+		for j,data in enumerate(frames):
+			k = v['offset'] + j
+			row_shard[k] = len(shards)-1
+			row_offset[k] = f.tell()
+			row_size[k] = len(data)
+			f.write(data)
+
+	if(f is not None):
+		f.close()
+	return (shards,row_shard,row_offset,row_size)
+
+class ShardStore(object):
+	#Reads the rows written by writeShards from memory-mapped shards, which
+	#are mapped on first use in each process.
+
+	def __init__(self,shard_dir,shards,row_shard,row_offset,row_size):
+		self.shard_files = [os.path.join(shard_dir,name) for name in shards]
+		self.shards = [None]*len(self.shard_files)
+		self.row_shard = row_shard
+		self.row_offset = row_offset
+		self.row_size = row_size
+
+	def read(self,k):
+		s = self.row_shard[k]
+		if(self.shards[s] is None):
+			self.shards[s] = np.memmap(self.shard_files[s],dtype=np.uint8,mode='r')
+
+		a = int(self.row_offset[k])
+		return self.shards[s][a:a+int(self.row_size[k])]
+
+def getFrameRow(vid_offsets,path):
+	#Row of frame <frame dir>/<n><ext> in the per-frame arrays of an index,
+	#given the first row of each frame dir.
+	vid_path,frame_name = os.path.split(path)
+	return vid_offsets[vid_path] + int(os.path.splitext(frame_name)[0]) - 1
+
+class ShardFrameSource(object):
+	#Reads the frames of a shard index from memory-mapped shards. Frames are
+	#still addressed by their original path, <frame dir>/<n><ext>, so the
+	#feed is unchanged. Shards are mapped on first use in each process.
+
+	def __init__(self,index_file):
+		header,arrays = readVidIndex(index_file)
+
+		self.store = ShardStore(os.path.dirname(index_file),header['shards'],arrays['frame_shard'],
+								arrays['frame_offset'],arrays['frame_size'])
+		self.vid_paths = [v['path'] for v in header['vids']]
+		self.vid_offsets = dict((v['path'],v['offset']) for v in header['vids'])
+
+	def readBytes(self,path):
+		return self.store.read(getFrameRow(self.vid_offsets,path))
+
+	def read(self,path,reduce=1):
+		return cv2.imdecode(self.readBytes(path),reduced_read_flags[reduce])
+
+video_exts = ['.mp4','.avi','.mov','.mkv']
+
+class CropFrameSource(object):
+	#Serves the person-centered tiles of a crop cache written by
+	#datageneration.buildCropCache: an annotation index, index.idx, with a
+	#(n_frames,2,3) array crop_A of the matrices taking frame coordinates to
+	#tile coordinates, and the tiles, encoded in their frames' format, in
+	#shards next to it (writeShards; the index header lists them under
+	#'crops' with the tile shape, and crop_shard, crop_offset and crop_size
+	#locate each tile). Whole frames are still read from their files.
+
+	def __init__(self,index_file):
+		header,arrays = readVidIndex(index_file)
+		crops = header['crops']
+
+		self.store = ShardStore(os.path.dirname(index_file),crops['shards'],arrays['crop_shard'],
+								arrays['crop_offset'],arrays['crop_size'])
+		self.shape = tuple(crops['shape'])
+		self.vid_paths = [v['path'] for v in header['vids']]
+		self.vid_offsets = dict((v['path'],v['offset']) for v in header['vids'])
+		self.crop_A = arrays['crop_A']
+
+	def cropTransform(self,path):
+		#3x3 matrix taking frame coordinates to those of the tile of a frame.
+		k = getFrameRow(self.vid_offsets,path)
+		return np.vstack((self.crop_A[k],[0,0,1.0]))
+
+	def readCrop(self,path):
+		return cv2.imdecode(self.store.read(getFrameRow(self.vid_offsets,path)),cv2.IMREAD_COLOR)
+
+	def read(self,path,reduce=1):
+		return cv2.imread(path,reduced_read_flags[reduce])
+
+def getVideoName(vid_path):
+	#The video file of <root>/frames/<vid> is <root>/videos/<vid>.<ext>
+	path,vid_name = os.path.split(vid_path)
+	video_name = path[:-6] + 'videos/' + vid_name
+	for ext in video_exts:
+		if(os.path.isfile(video_name + ext)):
+			return video_name + ext
+	raise IOError('No video file for ' + vid_path)
+
+class VideoReader(object):
+	#Decodes frames of one video file in order with cv2.VideoCapture and
+	#keeps the last run_frames of them. A frame up to seek_frames ahead of
+	#the current position is reached by decoding forward. Any other frame is
+	#seeked to, which makes the decoder jump to the keyframe before it and
+	#decode from there, so it costs about one keyframe interval of decoding.
+
+	def __init__(self,video_file,seek_frames,run_frames):
+		self.capture = cv2.VideoCapture(video_file)
+		if(not self.capture.isOpened()):
+			raise IOError('Could not open ' + video_file)
+		self.video_file = video_file
+		self.seek_frames = seek_frames
+		self.run_frames = run_frames
+		self.pos = 0
+		self.frames = OrderedDict()
+		self.n_seeks = 0
+
+	def read(self,n):
+		I = self.frames.get(n)
+		if(I is not None):
+			return I
+
+		if(n < self.pos or n - self.pos > self.seek_frames):
+			self.capture.set(cv2.CAP_PROP_POS_FRAMES,n)
+			self.pos = n
+			self.n_seeks += 1
+
+		while(self.pos <= n):
+			#Frames that would not be kept are skipped without converting them.
+			if(n - self.pos >= self.run_frames):
+				ok = self.capture.grab()
+			else:
+				ok,I = self.capture.read()
+				if(ok):
+					I.flags.writeable = False
+					self.frames[self.pos] = I
+					if(len(self.frames) > self.run_frames):
+						self.frames.popitem(last=False)
+			if(not ok):
+				raise IOError('Could not decode frame ' + str(n+1) + ' of ' + self.video_file)
+			self.pos += 1
+
+		return I
+
+	def close(self):
+		self.capture.release()
+
+class VideoFrameSource(object):
+	#Reads the frames of the videos in vid_paths from their video files
+	#(getVideoName) instead of their frame files. At most max_open videos
+	#are kept open. Readers are opened in the process that uses them, as
+	#decoder state cannot be shared with forked feed workers.
+
+	def __init__(self,vid_paths,seek_frames=32,run_frames=8,max_open=16):
+		self.vid_paths = vid_paths
+		self.seek_frames = seek_frames
+		self.run_frames = run_frames
+		self.max_open = max_open
+		self.readers = OrderedDict()
+		self.pid = os.getpid()
+		self.lock = threading.Lock()
+
+	def read(self,path,reduce=1):
+		vid_path,frame_name = os.path.split(path)
+		n = int(os.path.splitext(frame_name)[0]) - 1
+
+		with self.lock:
+			if(self.pid != os.getpid()):
+				self.readers = OrderedDict()
+				self.pid = os.getpid()
+
+			reader = self.readers.pop(vid_path,None)
+			if(reader is None):
+				reader = VideoReader(getVideoName(vid_path),self.seek_frames,self.run_frames)
+			self.readers[vid_path] = reader
+			while(len(self.readers) > self.max_open):
+				_,old = self.readers.popitem(last=False)
+				old.close()
+
+			I = reader.read(n)
+
+		return reduceFrame(I,reduce)
+
+def reduceFrame(I,reduce):
+	#Averages reduce x reduce blocks of pixels, matching the pixel grid of a
+	#reduced decode by readFrame.
+	if(reduce == 1):
+		return I
+	h = I.shape[0]//reduce
+	w = I.shape[1]//reduce
+	return cv2.resize(I[0:h*reduce,0:w*reduce],(w,h),interpolation=cv2.INTER_AREA)
+
+frame_source_kinds = ['files','shards','video','crops']
+
+def openFrameSource(vid_file,kind=None,seek_frames=32,run_frames=8):
+	#The frame source for the videos of vid_file, by kind: 'files' (None is
+	#returned and frames are read from their files), 'shards' (vid_file is
+	#an index written by buildFrameShards), 'video' (VideoFrameSource) or
+	#'crops' (vid_file is the index of a crop cache). Without a kind, shard
+	#and crop cache indexes use their shards or crops and all else its files.
+	header = None
+	if(vid_file.endswith('.idx')):
+		header = readVidIndex(vid_file)[0]
+
+	if(kind is None):
+		kind = 'files'
+		if(header is not None and 'shards' in header):
+			kind = 'shards'
+		elif(header is not None and 'crops' in header):
+			kind = 'crops'
+
+	if(kind not in frame_source_kinds):
+		raise ValueError('Unknown frame source ' + str(kind))
+	if(kind == 'shards'):
+		return ShardFrameSource(vid_file)
+	if(kind == 'crops'):
+		return CropFrameSource(vid_file)
+	if(kind == 'video'):
+		if(header is not None):
+			vid_paths = [v['path'] for v in header['vids']]
+		else:
+			vid_paths = readVidList(vid_file)[0]
+		return VideoFrameSource(vid_paths,seek_frames,run_frames)
+	return None
+
+
 '''
 def makeWarpExampleList(vid_file,n_examples):
 	
@@ -90,25 +720,21 @@ def makeWarpExampleList(vid_file,n_examples):
 
 
 def makeActionExampleList(vid_file,example_num):
-	
-	f = open(vid_file)
-	vid_paths = f.readlines()
-	f.close()
-	
+	#Pairs of the first frame of video example_num of vid_file with each of
+	#its frames, as an (n_frames,2) array of example records, together with
+	#the one-video vid_info_list they refer to.
+
+	vid_paths,classes = readVidList(vid_file)
 	vid_path = vid_paths[example_num]
-	path,vid_name = os.path.split(vid_path)	
-	info_name = path[:-6] + 'info/' + vid_name[:-1] + '.mat'
 
-	info = sio.loadmat(info_name)		
+	info = sio.loadmat(getInfoName(vid_path))
 	box = info['data']['bbox'][0][0]
 	X = info['data']['X'][0][0]
+	vid_info_list = [makeVidInfo(info,box,X,vid_path,getFrameExt(vid_path),class_id=classes[example_num])]
 
-	ex = []
-	for i in xrange(X.shape[2]):
-		l = []
-		l += getExampleInfo(vid_path,0,box,X)
-		l += getExampleInfo(vid_path,i,box,X)
-		ex.append(l)
+	n_frames = X.shape[2]
+	frames = np.stack((np.zeros(n_frames,dtype=np.int64),np.arange(n_frames)),axis=1)
+	ex = makeExamples(vid_info_list,0,frames.ravel()).reshape((n_frames,2))
 
-	return ex
+	return (vid_info_list,ex)
 
@@ -1,4 +1,5 @@
 import tensorflow as tf
+import numpy as np
 from keras import backend as K
 from keras.models import Model
 from keras.layers import Conv2D,Dense,Activation,Input,UpSampling2D,Dropout
@@ -8,6 +9,7 @@ from keras.applications.vgg19 import VGG19
 from keras.initializers import RandomNormal
 from keras.optimizers import Adam,RMSprop
 import keras
+import datageneration
 
 def myConv(x_in,nf,ks=3,strides=1,activation='lrelu',ki='he_normal',name=None,dropout=False):
 
@@ -63,6 +65,212 @@ def make_trainable(net,val):
 	for l in net.layers:
 		l.trainable = val
 
+def renderJointHeatmaps(posevec,param):
+	#In-graph datageneration.makeJointHeatmapsBatch from (B,2*n_joints) pose
+	#vectors: separable Gaussians, empty for joints on or outside the border.
+	pose_dn = param['posemap_downsample']
+	height = param['IMG_HEIGHT']/pose_dn
+	width = param['IMG_WIDTH']/pose_dn
+	sigma = param['sigma_joint']
+
+	joints = tf.reshape(posevec,[-1,param['n_joints'],2])/pose_dn
+	jx = joints[:,:,0:1]
+	jy = joints[:,:,1:2]
+	gx = tf.exp(-tf.square(tf.range(width,dtype=tf.float32) - jx)/(2*sigma**2))
+	gy = tf.exp(-tf.square(tf.range(height,dtype=tf.float32) - jy)/(2*sigma**2))
+
+	valid = (jx > 0) & (jy > 0) & (jx < width-1) & (jy < height-1)
+	gx = gx*tf.cast(valid,tf.float32)
+
+	maps = tf.expand_dims(gy,3)*tf.expand_dims(gx,2)
+	return tf.transpose(maps,[0,2,3,1])
+
+def renderLimbMaskPriors(posevec,param):
+	#In-graph datageneration.makeLimbMaskPriors from (B,2*n_joints) pose
+	#vectors, over the whole image. A mask exp(-q)/(max exp(-q) + 1e-6) is
+	#kept as exp(-s) with s = q + log(max exp(-q) + 1e-6) >= 0, so that the
+	#background 1 - mask = -expm1(-s) has no cancellation in float32.
+	#Rendered at the resolution of param['mask_downsample'], like the host.
+	dn = param['mask_downsample']
+	height = param['IMG_HEIGHT']/dn
+	width = param['IMG_WIDTH']/dn
+	cutoff = param['limb_mask_cutoff']
+
+	joints = tf.reshape(posevec,[-1,param['n_joints'],2])/dn
+	p0 = tf.reduce_mean(tf.gather(joints,datageneration.limb_top,axis=1),axis=2)
+	p1 = tf.reduce_mean(tf.gather(joints,datageneration.limb_bot,axis=1),axis=2)
+	center = (p0 + p1)/2.0
+	d = p1 - p0
+
+	sigma_x = tf.maximum(5.0/dn**2,tf.reduce_sum(tf.square(d),axis=2)/1.5)
+	sigma_y = tf.constant(datageneration.limb_sigma_perp/float(dn**2),dtype=tf.float32)
+	theta = tf.atan2(d[:,:,1],-d[:,:,0])
+
+	a = tf.square(tf.cos(theta))/(2*sigma_x) + tf.square(tf.sin(theta))/(2*sigma_y)
+	b = -tf.sin(2*theta)/(4*sigma_x) + tf.sin(2*theta)/(4*sigma_y)
+	c = tf.square(tf.sin(theta))/(2*sigma_x) + tf.square(tf.cos(theta))/(2*sigma_y)
+
+	#(B,1,1,n_limbs) coefficients against (1,H,1,1) and (1,1,W,1) pixel grids.
+	a,b,c,cx,cy = [tf.expand_dims(tf.expand_dims(t,1),1) for t in [a,b,c,center[:,:,0],center[:,:,1]]]
+	dx = tf.reshape(tf.range(width,dtype=tf.float32),[1,1,-1,1]) - cx
+	dy = tf.reshape(tf.range(height,dtype=tf.float32),[1,-1,1,1]) - cy
+	q = a*dx*dx + 2*b*dx*dy + c*dy*dy
+
+	q_min = tf.reduce_min(q,axis=[1,2])
+	log_norm = tf.reduce_logsumexp(tf.stack([-q_min,tf.ones_like(q_min)*np.log(1e-6)]),axis=0)
+	s = q + tf.expand_dims(tf.expand_dims(log_norm,1),1)
+
+	#Masks below cutoff are dropped, from the background as well.
+	masks = tf.exp(-s)
+	keep = tf.cast(masks >= cutoff,tf.float32)
+	masks = masks*keep
+	bg = -tf.expm1(-tf.reduce_min(s + (1 - keep)*1e4,axis=3))
+
+	return tf.log(tf.concat([tf.expand_dims(bg,3),masks],3) + 1e-10)
+
+def similarityParams(src,dst):
+	#In-graph transformations.make_similarity_batch for ...xNx2 tensors.
+	#Returns the tensors a0, a1, b0, b1.
+	src_mean = tf.reduce_mean(src,axis=-2)
+	dst_mean = tf.reduce_mean(dst,axis=-2)
+	xs = src[...,0] - src_mean[...,0:1]
+	ys = src[...,1] - src_mean[...,1:2]
+	xd = dst[...,0] - dst_mean[...,0:1]
+	yd = dst[...,1] - dst_mean[...,1:2]
+
+	norm = tf.reduce_sum(xs*xs + ys*ys,axis=-1)
+	valid = tf.cast(norm > 0,tf.float32)
+	norm = norm + (1 - valid)
+	a1 = valid*tf.reduce_sum(xs*xd + ys*yd,axis=-1)/norm
+	b1 = valid*tf.reduce_sum(xs*yd - ys*xd,axis=-1)/norm
+	a0 = dst_mean[...,0] - a1*src_mean[...,0] + b1*src_mean[...,1]
+	b0 = dst_mean[...,1] - b1*src_mean[...,0] - a1*src_mean[...,1]
+	return a0,a1,b0,b1
+
+def renderLimbTransforms(posevec_src,posevec_tgt,param):
+	#In-graph X_trans: the identity for the background, then the similarity
+	#taking each limb of the target pose onto the source pose, as in
+	#datageneration.getLimbTransformsBatch. Returns (B,2,3,n_limbs+1).
+	joints_src = tf.reshape(posevec_src,[-1,param['n_joints'],2])
+	joints_tgt = tf.reshape(posevec_tgt,[-1,param['n_joints'],2])
+
+	groups = [datageneration.limb_pairs,datageneration.limb_torso]
+	params = [similarityParams(tf.gather(joints_tgt,g,axis=1),tf.gather(joints_src,g,axis=1)) for g in groups]
+	a0,a1,b0,b1 = [tf.concat([p[k] for p in params],axis=1) for k in xrange(4)]
+
+	Ms = tf.stack([tf.stack([a1,-b1,a0],axis=1),tf.stack([b1,a1,b0],axis=1)],axis=1)
+	identity = tf.reshape(tf.constant([1.0,0,0,0,1.0,0]),[1,2,3,1])*tf.reshape(tf.ones_like(a0[:,0]),[-1,1,1,1])
+	return tf.concat([identity,Ms],axis=3)
+
+#datageneration.swapLeftRightJoints as a permutation of the joints.
+left_right_joints = [0,1,5,6,7,2,3,4,11,12,13,8,9,10]
+
+def augmentTransform(aug,param):
+	#In-graph datageneration.getWarpTransform augmentations: the (B,3,3)
+	#matrices for (B,6) rows (rflip,rscale,x_shift,y_shift,rdegree,rsat).
+	cx = (param['IMG_WIDTH']-1.0)/2.0
+	cy = (param['IMG_HEIGHT']-1.0)/2.0
+
+	flip = aug[:,0] >= 0.5
+	ones = tf.ones_like(aug[:,0])
+	zeros = tf.zeros_like(aug[:,0])
+	rscale = aug[:,1]
+	alpha = tf.cos(aug[:,4]*np.pi/180.0)
+	beta = tf.sin(aug[:,4]*np.pi/180.0)
+
+	def matrix(rows):
+		return tf.stack([tf.stack(row,axis=1) for row in rows],axis=1)
+
+	F = matrix([[tf.where(flip,-ones,ones),zeros,tf.where(flip,ones*2*cx,zeros)],
+				[zeros,ones,zeros],[zeros,zeros,ones]])
+	S = matrix([[rscale,zeros,aug[:,2]],[zeros,rscale,aug[:,3]],[zeros,zeros,ones]])
+	R = matrix([[alpha,beta,(1-alpha)*cx - beta*cy],[-beta,alpha,beta*cx + (1-alpha)*cy],
+				[zeros,zeros,ones]])
+
+	return tf.matmul(R,tf.matmul(S,F))
+
+def augmentBatch(args,param):
+	#In-graph version of the host augmentations for a batch of a feed with
+	#param['augment_in_graph']: [X_src,X_posevec_src,X_posevec_tgt,X_aug,Y]
+	#with images padded by datageneration.getCropPadding. Returns
+	#[X_src,X_posevec_src,X_posevec_tgt,Y] in the output window, augmented
+	#in the training phase and only cropped otherwise.
+	x_src,posevec_src,posevec_tgt,aug,y = args
+
+	width = param['IMG_WIDTH']
+	height = param['IMG_HEIGHT']
+	n_joints = param['n_joints']
+	pad = datageneration.getCropPadding(param)
+
+	def crop(im):
+		return im[:,pad[1]:pad[1]+height,pad[0]:pad[0]+width,:]
+
+	M = augmentTransform(aug,param)
+	flip = aug[:,0] >= 0.5
+	rsat = tf.reshape(aug[:,5],[-1,1,1,1])
+
+	#Tile pixels q are sampled at pad + M^-1 (q - pad). The images are
+	#shifted to [0,2] while warping so that the zero border is black.
+	P = tf.constant([[1.0,0,pad[0]],[0,1.0,pad[1]],[0,0,1.0]])
+	P_inv = tf.constant([[1.0,0,-pad[0]],[0,1.0,-pad[1]],[0,0,1.0]])
+	theta = tf.matmul(tf.matmul(tf.tile(tf.expand_dims(P,0),[tf.shape(M)[0],1,1]),
+								tf.matrix_inverse(M)),
+					  tf.tile(tf.expand_dims(P_inv,0),[tf.shape(M)[0],1,1]))[:,0:2,:]
+
+	def warpImage(im):
+		im = crop(affineWarp(im + 1.0,theta)) - 1.0
+		return tf.minimum(im*rsat,1.0)
+
+	def warpJoints(posevec):
+		joints = tf.reshape(posevec,[-1,n_joints,2])
+		joints = tf.matmul(joints,M[:,0:2,0:2],transpose_b=True) + tf.expand_dims(M[:,0:2,2],1)
+		joints = tf.where(flip,tf.gather(joints,left_right_joints,axis=1),joints)
+		return tf.reshape(joints,[-1,n_joints*2])
+
+	augmented = [warpImage(x_src),warpJoints(posevec_src),warpJoints(posevec_tgt),warpImage(y)]
+	cropped = [crop(x_src),posevec_src,posevec_tgt,crop(y)]
+	return [K.in_train_phase(a,c) for a,c in zip(augmented,cropped)]
+
+def augmenter(param):
+	#Returns augment(X,Y) applying augmentBatch to a training batch on the
+	#device. It runs ahead of the model rather than as one of its layers as
+	#the targets Y, which are not model inputs, need the same warp.
+	if(not param['render_in_graph']):
+		raise ValueError('augment_in_graph needs render_in_graph: the pose maps are made from the augmented joints.')
+
+	inputs = [K.placeholder(ndim=4),K.placeholder(ndim=2),K.placeholder(ndim=2),
+			  K.placeholder(ndim=2),K.placeholder(ndim=4)]
+	f = K.function(inputs + [K.learning_phase()],augmentBatch(inputs,param))
+
+	def augment(X,Y):
+		out = f(list(X) + [Y,1])
+		return out[0:3],out[3]
+
+	return augment
+
+def poseMapInputs(param):
+	#Inputs for the pose conditioning and the (B,H/pose_dn,W/pose_dn,n_joints)
+	#source and target pose maps they give. With param['render_in_graph'] the
+	#inputs are the two (B,2*n_joints) pose vectors and the maps are rendered
+	#by renderJointHeatmaps, otherwise the inputs are the maps.
+
+	IMG_HEIGHT = param['IMG_HEIGHT']
+	IMG_WIDTH = param['IMG_WIDTH']
+	n_joints = param['n_joints']
+	pose_dn = param['posemap_downsample']
+	map_shape = (IMG_HEIGHT/pose_dn,IMG_WIDTH/pose_dn,n_joints)
+
+	if(param['render_in_graph']):
+		posevec_src = Input(shape=(n_joints*2,))
+		posevec_tgt = Input(shape=(n_joints*2,))
+		pose_src = Lambda(lambda v: renderJointHeatmaps(v,param),output_shape=map_shape)(posevec_src)
+		pose_tgt = Lambda(lambda v: renderJointHeatmaps(v,param),output_shape=map_shape)(posevec_tgt)
+		return [posevec_src,posevec_tgt],pose_src,pose_tgt
+
+	pose_src = Input(shape=map_shape)
+	pose_tgt = Input(shape=map_shape)
+	return [pose_src,pose_tgt],pose_src,pose_tgt
+
 def discriminator(param):
 
 	IMG_HEIGHT = param['IMG_HEIGHT']
@@ -71,8 +279,7 @@ def discriminator(param):
 	pose_dn = param['posemap_downsample']
 
 	x_tgt = Input(shape=(IMG_HEIGHT,IMG_WIDTH,3))
-	x_src_pose = Input(shape=(IMG_HEIGHT/pose_dn,IMG_WIDTH/pose_dn,14))
-	x_tgt_pose = Input(shape=(IMG_HEIGHT/pose_dn,IMG_WIDTH/pose_dn,14))
+	pose_inputs,x_src_pose,x_tgt_pose = poseMapInputs(param)
 
 	x = myConv(x_tgt,64,ks=5,strides=2) #128
 	x = concatenate([x,x_src_pose,x_tgt_pose])
@@ -89,7 +296,7 @@ def discriminator(param):
 	y = myDense(x,1,activation='sigmoid')
 	#y = myDense(x,1,activation='linear') #for wgan
 
-	model = Model(inputs=[x_tgt,x_src_pose,x_tgt_pose],outputs=y, name='discriminator')
+	model = Model(inputs=[x_tgt]+pose_inputs,outputs=y, name='discriminator')
 	return model
 
 def wass(y_true,y_pred):
@@ -103,18 +310,26 @@ def gan(generator,discriminator,param,feat_net,feat_weights,disc_loss,lr):
 	pose_dn = param['posemap_downsample']
 
 	src_in = Input(shape=(IMG_HEIGHT,IMG_WIDTH,3))
-	pose_src = Input(shape=(IMG_HEIGHT/pose_dn,IMG_WIDTH/pose_dn,14))
-	pose_tgt = Input(shape=(IMG_HEIGHT/pose_dn,IMG_WIDTH/pose_dn,14))
-	mask_in = Input(shape=(IMG_HEIGHT,IMG_WIDTH,11))	
-	trans_in = Input(shape=(2,3,11))
+	if(param['render_in_graph']):
+		#Generator and discriminator both render from the pose vectors.
+		pose_src = Input(shape=(n_joints*2,))
+		pose_tgt = Input(shape=(n_joints*2,))
+		gen_inputs = [src_in,pose_src,pose_tgt]
+	else:
+		pose_src = Input(shape=(IMG_HEIGHT/pose_dn,IMG_WIDTH/pose_dn,14))
+		pose_tgt = Input(shape=(IMG_HEIGHT/pose_dn,IMG_WIDTH/pose_dn,14))
+		mask_dn = param['mask_downsample']
+		mask_in = Input(shape=(IMG_HEIGHT/mask_dn,IMG_WIDTH/mask_dn,11))	
+		trans_in = Input(shape=(2,3,11))
+		gen_inputs = [src_in,pose_src,pose_tgt,mask_in,trans_in]
 
 	make_trainable(discriminator, False)
 	#y_gen = generator([src_in,pose_src,pose_tgt])
-	y_gen = generator([src_in,pose_src,pose_tgt,mask_in,trans_in])
+	y_gen = generator(gen_inputs)
 	y_class = discriminator([y_gen,pose_src,pose_tgt])
 	
 	#gan = Model(inputs=[src_in,pose_src,pose_tgt],outputs=[y_gen,y_class], name='gan')
-	gan = Model(inputs=[src_in,pose_src,pose_tgt,mask_in,trans_in],outputs=[y_gen,y_class], name='gan')
+	gan = Model(inputs=gen_inputs,outputs=[y_gen,y_class], name='gan')
 
 	return gan
 
@@ -294,16 +509,28 @@ def network_fgbg(param):
 	IMG_WIDTH = param['IMG_WIDTH']
 	n_joints = param['n_joints']
 	pose_dn = param['posemap_downsample']
+	mask_dn = param['mask_downsample']
+	mask_shape = (IMG_HEIGHT/mask_dn,IMG_WIDTH/mask_dn,11)
 
 	src_in = Input(shape=(IMG_HEIGHT,IMG_WIDTH,3))
-	pose_src = Input(shape=(IMG_HEIGHT/pose_dn,IMG_WIDTH/pose_dn,14))
-	pose_tgt = Input(shape=(IMG_HEIGHT/pose_dn,IMG_WIDTH/pose_dn,14))
-	src_mask_prior = Input(shape=(IMG_HEIGHT,IMG_WIDTH,11))	
-	trans_in = Input(shape=(2,3,11))
+	pose_inputs,pose_src,pose_tgt = poseMapInputs(param)
+	if(param['render_in_graph']):
+		src_mask_prior = Lambda(lambda v: renderLimbMaskPriors(v,param),
+								output_shape=mask_shape)(pose_inputs[0])
+		trans_in = Lambda(lambda v: renderLimbTransforms(v[0],v[1],param),
+						  output_shape=(2,3,11))(pose_inputs)
+		inputs = [src_in] + pose_inputs
+	else:
+		src_mask_prior = Input(shape=mask_shape)	
+		trans_in = Input(shape=(2,3,11))
+		inputs = [src_in] + pose_inputs + [src_mask_prior,trans_in]
 
 	#1. FG/BG separation
 	x = unet(src_in,pose_src,[64]*2+[128]*9,[128]*4+[32])
 	src_mask_delta = myConv(x,11,activation='linear')
+	if(mask_dn > 1):
+		src_mask_prior = Lambda(lambda arg: tf.image.resize_bilinear(arg,[IMG_HEIGHT,IMG_WIDTH],align_corners=False),
+								output_shape=(IMG_HEIGHT,IMG_WIDTH,11))(src_mask_prior)
 	src_mask = keras.layers.add([src_mask_delta,src_mask_prior])
 	src_mask = Activation('softmax',name='mask_src')(src_mask)
 
@@ -331,7 +558,7 @@ def network_fgbg(param):
 	bg_tgt = keras.layers.multiply([bg_tgt,bg_mask],name='bg_tgt_masked')
 	y = keras.layers.add([fg_tgt,bg_tgt])
 
-	model = Model(inputs=[src_in,pose_src,pose_tgt,src_mask_prior,trans_in], outputs=[y])
+	model = Model(inputs=inputs, outputs=[y])
 
 	return model
 
@@ -344,13 +571,12 @@ def network_pix2pix(param):
 	pose_dn = param['posemap_downsample']
 
 	src_in = Input(shape=(IMG_HEIGHT,IMG_WIDTH,3))
-	pose_src = Input(shape=(IMG_HEIGHT/pose_dn,IMG_WIDTH/pose_dn,14))
-	pose_tgt = Input(shape=(IMG_HEIGHT/pose_dn,IMG_WIDTH/pose_dn,14))
+	pose_inputs,pose_src,pose_tgt = poseMapInputs(param)
 
 	x = unet(src_in,concatenate([pose_src,pose_tgt]),[64]+[128]*3+[256]*7,[256,256,256,128,64])
 	y = myConv(x,3,activation='tanh')
 
-	model = Model(inputs=[src_in,pose_src,pose_tgt], outputs=[y])
+	model = Model(inputs=[src_in]+pose_inputs, outputs=[y])
 	return model
 
 '''
@@ -12,13 +12,83 @@ def getGeneralParams():
 	param['posemap_downsample'] = 2
 	param['sigma_joint'] = 7/4.0
 	param['n_joints'] = 14
+	#Limb mask values below this are dropped before taking the log-prior, and
+	#each limb is only rendered inside the box around its values above it.
+	#At 1e-12 the log-priors stay within 0.01 of the uncut ones. 1e-4 renders
+	#about a third of the pixels, but moves the log-priors by up to ~14.
+	param['limb_mask_cutoff'] = 1e-12
+	#Limb mask priors are rendered at the image resolution divided by this
+	#and upsampled by network_fgbg.
+	param['mask_downsample'] = 1
+	#If set, the feed gives pose vectors instead of pose maps, limb mask
+	#priors and limb transforms, and the networks render those in the graph
+	#(networks.poseMapInputs).
+	param['render_in_graph'] = False
+	#If set (needs render_in_graph), augmenting feeds give padded tiles of the
+	#centered output window and the augmentations, which the trainer applies
+	#on the device with networks.augmenter.
+	param['augment_in_graph'] = False
+	#If set, feeds give the joint heatmaps as (B,n_joints,3) (x,y,valid)
+	#records, which the trainer renders with datageneration.densifyBatch.
+	param['sparse_heatmaps'] = False
 
 	param['test_interval'] = 500
+	#Fixed evaluation set (datageneration.createEvalFeed): where it is stored
+	#and how many batches it holds.
+	param['eval_dir'] = 'test_eval'
+	param['eval_batches'] = 8
 	param['model_save_interval'] = 5000
 	param['project_dir'] = '/afs/csail.mit.edu/u/b/balakg/pose/pose2image'
 
 	param['batch_size'] = 6
 	param['seq_len'] = 2
+
+	#Feed worker processes (0 builds batches in the training process) and
+	#the number of ready batches they may queue up ahead of the trainer.
+	#Workers are forked by every createFeed, so they are opt-in.
+	param['feed_workers'] = 0
+	param['feed_queue_size'] = 8
+	#Pass the workers' batches through shared memory (datageneration.SlabRing)
+	#instead of pickling them. A batch then stays valid until the next is drawn.
+	#The slab holds feed_queue_size+1 batches (about 37MB each at 256x256).
+	param['feed_shared_memory'] = False
+	#Preallocated batch buffers each feed cycles through, and whether images
+	#are shipped as uint8 and normalized by the trainer (datageneration.normalizeBatch).
+	param['feed_n_buffers'] = 2
+	param['feed_uint8_images'] = False
+	#Byte budget of the decoded frame cache in each feed process (0 disables it).
+	param['frame_cache_bytes'] = 0
+	#Largest factor (1, 2, 4 or 8) by which frames may be decoded at reduced
+	#resolution when the crop downsamples them anyway. 1 always decodes in full.
+	param['max_decode_reduction'] = 8
+	#Output pixels by which datageneration.buildCropCache tiles are padded
+	#beyond what augmentations need. A pair's window follows the frame with
+	#the larger person, so the other frame's tile needs room for its motion;
+	#frames whose tile still misses the window are decoded.
+	param['crop_margin'] = 64
+	#If > 0, videos from a .txt list are loaded on first use and at most this
+	#many are kept in memory (datareader.LazyVidInfoList).
+	param['vid_cache_size'] = 0
+	#With createFeed(...,frame_source='video'), frames at most this many frames
+	#ahead of a video's decoder are decoded to rather than seeked to, and the
+	#last video_run_frames decoded frames of each video are kept.
+	param['video_seek_frames'] = 32
+	param['video_run_frames'] = 8
+	#If > 1, each sampled video gives the pairs among this many of its frames,
+	#one to each of locality_frames*(locality_frames-1)/2 batches, and its
+	#frames are decoded once for all of them. Those batches are interleaved
+	#with the batches of locality_groups-1 other sets of videos, so that
+	#consecutive batches do not share videos.
+	param['locality_frames'] = 0
+	param['locality_groups'] = 6
+	#Byte budget of the LRU of frames decoded for locality groups in each feed
+	#process (locality_groups*batch_size*locality_frames frames per group).
+	param['locality_cache_bytes'] = 2**28
+	#If > 1, decoded and centered pairs are kept in a reservoir of
+	#reuse_reservoir_size pairs (datageneration.SampleReservoir) and each is
+	#rendered this many times with fresh augmentations.
+	param['sample_reuse'] = 1
+	param['reuse_reservoir_size'] = 64
 	return param
 
 '''
@@ -25,7 +25,6 @@ def train(model_name,gpu_id):
 		os.mkdir(network_dir)
 
 	train_feed=datageneration.createFeed(params,"train_vids.txt")
-	test_feed=datageneration.createFeed(params,"test_vids.txt")
 	
 	config = tf.ConfigProto()
 	config.gpu_options.allow_growth = True
@@ -39,6 +38,9 @@ def train(model_name,gpu_id):
 		model = networks.network_fgbg(params)
 		#model.load_weights('../results/networks/fgbg_vgg/60000.h5')
 		model.compile(optimizer=Adam(lr=1e-4),loss=[networks.vggLoss(vgg_model,response_weights)])
+		augment = None
+		if(params['augment_in_graph']):
+			augment = networks.augmenter(params)
 
 	#model.summary()
 	#return
@@ -51,6 +53,10 @@ def train(model_name,gpu_id):
 		#return
 
 		X,Y = next(train_feed)			
+		X,Y = datageneration.normalizeBatch(X,Y)
+		X = datageneration.densifyBatch(X,params)
+		if(augment is not None):
+			X,Y = augment(X,Y)
 
 		with tf.device(gpu):
 			train_loss = model.train_on_batch(X,Y)
@@ -60,14 +66,18 @@ def train(model_name,gpu_id):
 		util.printProgress(step,0,train_loss,end-start)
 
 		if(step % params['test_interval'] == 0):
-			n_batches = 8
+			n_batches = 0
 			test_loss = 0
-			for j in xrange(n_batches):	
-				X,Y = next(test_feed)			
-				test_loss += np.array(model.test_on_batch(X,Y))
+			for X,Y in datageneration.createEvalFeed(params,"test_vids.txt"):
+				X,Y = datageneration.normalizeBatch(X,Y)
+				X = datageneration.densifyBatch(X,params)
+				test_loss += np.array(model.test_on_batch(X[0:len(model.inputs)],Y))
+				n_batches += 1
 			
 			test_loss /= (n_batches)
 			util.printProgress(step,1,test_loss,0)
+			if(datageneration.reuse_stats is not None):
+				print datageneration.reuse_stats.stats()
 
 		if(step > 0 and step % params['model_save_interval']==0):
 			model.save(network_dir + '/' + str(step) + '.h5')			
@@ -22,7 +22,6 @@ def train(model_name,gpu_id):
 		os.mkdir(network_dir)
 
 	train_feed=datageneration.createFeed(params,"train_vids.txt")
-	test_feed=datageneration.createFeed(params,"test_vids.txt")
 
 	batch_size = params['batch_size']
 
@@ -53,10 +52,17 @@ def train(model_name,gpu_id):
 			gan = networks.gan(generator,discriminator,params,vgg_model,response_weights,disc_loss,gan_lr)
 			gan.compile(optimizer=Adam(lr=gan_lr),loss=[networks.vggLoss(vgg_model,response_weights), 'binary_crossentropy'], 
 						loss_weights=[1.0,disc_loss])
+			augment = None
+			if(params['augment_in_graph']):
+				augment = networks.augmenter(params)
 
 		for step in xrange(10001):
 
 			X,Y = next(train_feed)
+			X,Y = datageneration.normalizeBatch(X,Y)
+			X = datageneration.densifyBatch(X,params)
+			if(augment is not None):
+				X,Y = augment(X,Y)
 
 			with tf.device(gpu):
 				gen = generator.predict(X) #[0:3])	
@@ -81,6 +87,10 @@ def train(model_name,gpu_id):
 			#TRAIN GAN
 			L = np.ones([batch_size])
 			X,Y = next(train_feed)
+			X,Y = datageneration.normalizeBatch(X,Y)
+			X = datageneration.densifyBatch(X,params)
+			if(augment is not None):
+				X,Y = augment(X,Y)
 			g_loss = gan.train_on_batch(X,[Y,L])
 			util.printProgress(step,0,[g_loss[1],d_loss])
 
@@ -23,7 +23,6 @@ def train(model_name,gpu_id):
 		os.mkdir(network_dir)
 
 	train_feed=datageneration.createFeed(params,"train_vids.txt",50000)
-	test_feed=datageneration.createFeed(params,"test_vids.txt",5000)
 	
 	batch_size = params['batch_size']
 
@@ -48,6 +47,9 @@ def train(model_name,gpu_id):
 		discriminator = networks.discriminator(params)
 		discriminator.compile(loss=networks.wass,optimizer=RMSprop(disc_lr))
 		gan = networks.gan(generator,discriminator,params,vgg_model,response_weights,disc_loss,gan_lr)
+		augment = None
+		if(params['augment_in_graph']):
+			augment = networks.augmenter(params)
 
 
 	for step in xrange(vgg_model_num+1,vgg_model_num+5001):
@@ -58,6 +60,10 @@ def train(model_name,gpu_id):
 				l.set_weights(weights)
 
 			X,Y = next(train_feed)
+			X,Y = datageneration.normalizeBatch(X,Y)
+			X = datageneration.densifyBatch(X,params)
+			if(augment is not None):
+				X,Y = augment(X,Y)
 
 			with tf.device(gpu):
 				gen = generator.predict(X)	
@@ -79,6 +85,10 @@ def train(model_name,gpu_id):
 		#TRAIN GAN
 		L = -1*np.ones(batch_size)
 		X,Y = next(train_feed)
+		X,Y = datageneration.normalizeBatch(X,Y)
+		X = datageneration.densifyBatch(X,params)
+		if(augment is not None):
+			X,Y = augment(X,Y)
 		g_loss = gan.train_on_batch(X,[Y,L])
 		util.printProgress(step,0,[g_loss[1],d_loss])
 
@@ -47,8 +47,8 @@ def train(dataset,gpu_id):
 		model = Model(fgbg.inputs, outputs)
 
 
-	test = datareader.makeActionExampleList('test_vids.txt',1)
-	feed = datageneration.warpExampleGenerator(test,params,do_augment=False,return_pose_vectors=True)
+	#Frame 0 of the video rendered in the pose of each of its frames, in order.
+	vid_info_list,test = datareader.makeActionExampleList('test_vids.txt',1)
 
 	
 	n_frames = len(test)
@@ -59,8 +59,10 @@ def train(dataset,gpu_id):
 
 	for i in xrange(n_frames):
 		print i
-		X,Y = next(feed)		
-		pred = model.predict(X[:-2])
+		X,Y = datageneration.makeWarpBatch(vid_info_list,params,[(0,test[i]['frame'],None)],True)
+		X,Y = datageneration.normalizeBatch(X,Y)
+		X = datageneration.densifyBatch(X,params)
+		pred = model.predict(X[0:len(model.inputs)])
 		true_action[:,:,:,i] = convert(np.reshape(Y,(256,256,3)))		
 		pred_action[:,:,:,i] = convert(np.reshape(pred[0],(256,256,3)))
 		mask[:,:,:,i] = pred[1]		
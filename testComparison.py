@@ -48,8 +48,7 @@ def train(dataset,gpu_id):
 	params = param.getGeneralParams()
 	gpu = '/gpu:' + str(gpu_id)
 
-	np.random.seed(17)
-	feed = datageneration.createFeed(params,'test_vids.txt',5000,False,True,True)
+	feed = datageneration.createEvalFeed(params,'test_vids.txt',batch_size=1,return_class=True)
 	
 	config = tf.ConfigProto()
 	config.gpu_options.allow_growth = True
@@ -85,15 +84,16 @@ def train(dataset,gpu_id):
 		ed_l1 = networks.network_pix2pix(params,vgg_model,response_weights,loss='l1')
 		ed_l1.load_weights('../results/networks/ed_l1/80000.h5')	
 	
-	n_examples = 500
+	n_examples = params['eval_batches']*params['batch_size']
 	
 	metrics = np.zeros((n_examples,9))
 	poses = np.zeros((n_examples,28*2))
 	classes = np.zeros(n_examples)
 
-	for j in xrange(n_examples):	
+	for j,(X,Y) in enumerate(feed):	
 		print j
-		X,Y = next(feed)		
+		X,Y = datageneration.normalizeBatch(X,Y)
+		X = datageneration.densifyBatch(X,params)
 
 		pred_l1 = ed_l1.predict(X[:3]) #X[:-3])
 		pred_vgg = ed_vgg.predict(X[:3]) #X[:-3])
@@ -20,21 +20,7 @@ def train(dataset,gpu_id):
 	params = param.getGeneralParams()
 	gpu = '/gpu:' + str(gpu_id)
 
-	lift_params = param.getDatasetParams('weightlifting')
-	golf_params = param.getDatasetParams('golfswinghd')
-	workout_params = param.getDatasetParams('workout')
-	tennis_params = param.getDatasetParams('tennis')
-	aux_params = param.getDatasetParams('test-aux')
-
-	_,lift_test = datareader.makeWarpExampleList(lift_params,0,2000,2,1)
-	_,golf_test = datareader.makeWarpExampleList(golf_params,0,5000,2,2)
-	_,workout_test = datareader.makeWarpExampleList(workout_params,0,2000,2,3)
-	_,tennis_test = datareader.makeWarpExampleList(tennis_params,0,2000,2,4)
-	_,aux_test = datareader.makeWarpExampleList(aux_params,0,2000,2,5)
-
-	test = lift_test + golf_test+workout_test + tennis_test + aux_test
-	feed = datageneration.warpExampleGenerator(test,params,do_augment=False,draw_skeleton=False,skel_color=(0,0,255),
-			return_pose_vectors=True)
+	feed = datageneration.createEvalFeed(params,'test_vids.txt')
 	
 
 	config = tf.ConfigProto()
@@ -59,13 +45,12 @@ def train(dataset,gpu_id):
 			gan.load_weights('../results/networks/gan/10000.h5')
 		
 	
-		np.random.seed(17)
-		n_batches = 25
-		for j in xrange(n_batches):	
+		for j,(X,Y) in enumerate(feed):	
 			print j
-			X,Y = next(feed)		
-			loss = gen.evaluate(X[0:-2],Y)
-			pred = gen.predict(X[0:-2])
+			X,Y = datageneration.normalizeBatch(X,Y)
+			X = datageneration.densifyBatch(X,params)
+			loss = gen.evaluate(X[0:len(gen.inputs)],Y)
+			pred = gen.predict(X[0:len(gen.inputs)])
 
 			sio.savemat('results/outputs/' + str(j) + '.mat',{'X': X[0],'Y': Y,'pred':pred,'loss':loss,
 							'src_pose': X[-2], 'tgt_pose': X[-1]})
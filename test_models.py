@@ -19,12 +19,6 @@ def train(gpu_id):
 	params = param.getGeneralParams()
 	gpu = '/gpu:' + str(gpu_id)
 
-	test_params = param.getDatasetParams('test-aux')
-
-	_,test = datareader.makeWarpExampleList(test_params,0,200,2,0)
-
-	feed = datageneration.warpExampleGenerator(test,params,do_augment=False,draw_skeleton=False,skel_color=(0,0,255))
-	
 
 	config = tf.ConfigProto()
 	config.gpu_options.allow_growth = True
@@ -42,16 +36,15 @@ def train(gpu_id):
 			response_weights = sio.loadmat('mean_response.mat')
 			fgbg = networks.network_fgbg(params,vgg_model,response_weights,True)
 	
-		np.random.seed(17)
-
-
-		n_batches = 50
 		for i in xrange(146000,1452000,2000):
 			fgbg.load_weights('../results/networks/fgbg_boundary/' + str(i) + '.h5')
+			n_batches = 0
 			loss = 0
-			for j in xrange(n_batches):	
-				X,Y = next(feed)		
-				loss += fgbg.test_on_batch(X,Y)
+			for X,Y in datageneration.createEvalFeed(params,'test_vids.txt'):	
+				X,Y = datageneration.normalizeBatch(X,Y)
+				X = datageneration.densifyBatch(X,params)
+				loss += fgbg.test_on_batch(X[0:len(fgbg.inputs)],Y)
+				n_batches += 1
 			
 			loss /= n_batches
 			print loss
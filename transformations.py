@@ -132,6 +132,47 @@ def make_similarity(src, dst,flip=False):
 
     return params #, params_explicit
 
+def make_similarity_batch(src, dst):
+    '''
+    Closed-form least-squares version of `make_similarity` for many point
+    sets at once. Same parameter order:
+        a0, a1, b0, b1
+    where the transformation is defined as:
+        X = a0 + a1*x - b1*y
+        Y = b0 + b1*x + a1*y
+
+    With the points centered on their means, the solution is
+        a1 = sum(x*X + y*Y) / sum(x^2 + y^2)
+        b1 = sum(x*Y - y*X) / sum(x^2 + y^2)
+    and a0, b0 map the source mean onto the destination mean. If all
+    source points coincide, only the translation is fitted.
+
+    :param src: :class:`numpy.array`
+        ...xNx2 coordinate arrays of source coordinate systems
+    :param dst: :class:`numpy.array`
+        ...xNx2 coordinate arrays of destination coordinate systems
+
+    :returns: :class:`numpy.array`
+        ...x4 parameter arrays
+    '''
+
+    src_mean = np.mean(src, axis=-2)
+    dst_mean = np.mean(dst, axis=-2)
+    xs = src[...,0] - src_mean[...,0:1]
+    ys = src[...,1] - src_mean[...,1:2]
+    xd = dst[...,0] - dst_mean[...,0:1]
+    yd = dst[...,1] - dst_mean[...,1:2]
+
+    norm = np.sum(xs*xs + ys*ys, axis=-1)
+    valid = norm > 0
+    norm = np.where(valid, norm, 1.0)
+    a1 = np.where(valid, np.sum(xs*xd + ys*yd, axis=-1) / norm, 0.0)
+    b1 = np.where(valid, np.sum(xs*yd - ys*xd, axis=-1) / norm, 0.0)
+    a0 = dst_mean[...,0] - a1*src_mean[...,0] + b1*src_mean[...,1]
+    b0 = dst_mean[...,1] - b1*src_mean[...,0] - a1*src_mean[...,1]
+
+    return np.stack([a0, a1, b0, b1], axis=-1)
+
 def similarity_transform(coords, params, inverse=False):
     '''
     Apply similarity transformation.